@@ -0,0 +1,79 @@
+"""Measure the time spent in the audio callback.
+
+The deck is driven by an offline stream, so no audio hardware is
+needed and the results are reproducible. Run from the top directory:
+
+    python -m benchmarks.bench_callback [seconds]
+"""
+import sys
+import time
+import functools
+from overdub import audio
+from overdub.deck import Deck
+from overdub.offline import OfflineStream
+from overdub.tape import Tape
+
+
+def make_tape(numblocks, fmt):
+    tape = Tape(fmt.bytes_per_block)
+    block = bytes(range(256)) * (fmt.bytes_per_block // 256)
+    for _ in range(numblocks):
+        tape.append(block)
+    return tape
+
+
+def make_deck(fmt, length, layered=False, tracks=1, **options):
+    """Return a deck with length blocks of audio on each track.
+
+    options are passed on to OfflineStream.
+    """
+    backend = functools.partial(OfflineStream, **options)
+    deck = Deck(fmt, layered=layered, backend=backend)
+    deck.latency_frames = 0
+
+    if layered:
+        for _ in range(tracks):
+            deck.tape.add_track(make_tape(length, fmt))
+    else:
+        deck.tape = make_tape(length, fmt)
+    return deck
+
+
+def time_stream(deck):
+    """Run the deck's stream to the end. Returns the time it took."""
+    start = time.perf_counter()
+    deck.start_stream()
+    deck.stop_stream()
+    return time.perf_counter() - start
+
+
+def run(name, numblocks, fmt, layered=False, record=False, tracks=1):
+    deck = make_deck(
+        fmt, numblocks, layered=layered, tracks=tracks, numblocks=numblocks
+    )
+    if record:
+        deck.record()
+    else:
+        deck.play()
+
+    elapsed = time_stream(deck)
+
+    micros = elapsed / numblocks * 1e6
+    budget = fmt.seconds_per_block * 1e6
+    print(f'  {name:20} {micros:8.1f} us/block  ({micros / budget:.1%})')
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    fmt = audio.default_format
+    numblocks = fmt.sec2block(seconds)
+
+    print(f'{numblocks} blocks, budget {fmt.seconds_per_block * 1e6:.0f} us')
+    run('play', numblocks, fmt)
+    run('record', numblocks, fmt, record=True)
+    run('layered play', numblocks, fmt, layered=True, tracks=4)
+    run('layered record', numblocks, fmt, layered=True, record=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure WAV load and save throughput.
+
+Run from the top directory:
+
+    python -m benchmarks.bench_io [megabytes]
+"""
+import os
+import sys
+import time
+import tempfile
+from overdub import audio
+from overdub.tape import Tape
+
+
+def make_tape(megabytes):
+    tape = Tape(audio.bytes_per_block)
+    chunk = os.urandom(tape.bytes_per_chunk)
+    for _ in range(max(1, megabytes * 2**20 // len(chunk))):
+        tape.extend(chunk)
+    return tape
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tape = make_tape(megabytes)
+    size = len(tape) * audio.bytes_per_block / 2**20
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'bench.wav')
+
+        start = time.perf_counter()
+        audio.save(filename, tape)
+        save_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = audio.load(filename)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in audio.iter_blocks(filename):
+            pass
+        iter_time = time.perf_counter() - start
+
+    assert len(loaded) == len(tape)
+
+    print(f'{size:.0f} MB ({len(tape)} blocks)')
+    print(f'  save         {size / save_time:8.0f} MB/s')
+    print(f'  load         {size / load_time:8.0f} MB/s')
+    print(f'  iter_blocks  {size / iter_time:8.0f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
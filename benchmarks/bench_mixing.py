@@ -0,0 +1,62 @@
+"""Time the block mixing done in the audio callback.
+
+Run from the top directory:
+
+    python -m benchmarks.bench_mixing
+"""
+import os
+import time
+from overdub import mixing
+
+frames_per_block = 1024
+bytes_per_block = frames_per_block * 4
+seconds_per_block = frames_per_block / 44100
+silence = b'\0' * bytes_per_block
+
+
+def noise_block():
+    return os.urandom(bytes_per_block)
+
+
+def time_per_call(func, *args, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def simulate_callback(inblock, tapeblock):
+    """Do the mixing done by Deck._audio_callback while recording."""
+    mixing.sum_blocks([tapeblock, inblock], silence)
+    outsum = mixing.sum_blocks([inblock, tapeblock], silence)
+    mixing.get_max_value(outsum)
+
+
+def main():
+    a = noise_block()
+    b = noise_block()
+    blocks = [noise_block() for _ in range(8)]
+
+    block_ms = seconds_per_block * 1e3
+    print(f'Block: {frames_per_block} frames ({block_ms:.1f} ms)')
+    print()
+
+    for name in mixing.backends:
+        mixing.use(name)
+        repeat = 10 if name == 'python' else 1000
+
+        add = time_per_call(mixing.add_blocks, a, b, repeat=repeat)
+        sum8 = time_per_call(mixing.sum_blocks, blocks, silence, repeat=repeat)
+        peak = time_per_call(mixing.get_max_value, a, repeat=repeat)
+        callback = time_per_call(simulate_callback, a, b, repeat=repeat)
+        load = callback / seconds_per_block * 100
+
+        print(f'{name}:')
+        print(f'  add_blocks          {add * 1e6:10.1f} us')
+        print(f'  sum_blocks (8)      {sum8 * 1e6:10.1f} us')
+        print(f'  get_max_value       {peak * 1e6:10.1f} us')
+        print(f'  callback per block  {callback * 1e6:10.1f} us ({load:.2f}%)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Run all benchmarks and save the results as JSON.
+
+Run from the top directory:
+
+    python -m benchmarks.suite [--sizes 10,100,1000] [--output FILE]
+    python -m benchmarks.suite --compare old.json new.json
+
+Each result has ops/s, microseconds per block and the peak resident
+memory of the process (in MB) when the benchmark finished. Load and
+save run in a separate process per file size, which resets its peak
+memory first so the peak is their own. A new process starts out with
+the peak of its parent, so this only works where the peak can be reset
+(Linux). Elsewhere the numbers include the peak of the suite itself.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import concurrent.futures
+import multiprocessing
+from overdub import audio
+from overdub import mixing
+from overdub import session
+from overdub.deck import record_block
+from overdub.tape import Tape
+from .bench_callback import make_deck, time_stream
+from .bench_io import make_tape
+from .bench_mixing import noise_block
+
+fmt = audio.default_format
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in MB."""
+    try:
+        # Unlike ru_maxrss, VmHWM is cleared by reset_peak_rss().
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return maxrss / 1024
+
+
+def result(name, ops, seconds, blocks_per_op=1, **info):
+    return dict(
+        name=name,
+        ops_per_second=ops / seconds,
+        us_per_block=seconds / (ops * blocks_per_op) * 1e6,
+        peak_rss_mb=peak_rss(),
+        **info,
+    )
+
+
+def time_calls(func, *args, min_time=0.2):
+    """Call func until min_time has passed. Returns (calls, seconds)."""
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+
+    while True:
+        for _ in range(batch):
+            func(*args)
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls, elapsed
+        batch *= 2
+
+
+def bench_mixing():
+    blocks = [noise_block() for _ in range(32)]
+    default = mixing.backend
+
+    for backend in mixing.backends:
+        mixing.use(backend)
+        # The pure Python backend is very slow.
+        min_time = 0.05 if backend == 'python' else 0.2
+
+        calls, seconds = time_calls(
+            mixing.add_blocks, blocks[0], blocks[1], min_time=min_time
+        )
+        yield result('add_blocks', calls, seconds, backend=backend)
+
+        for inputs in (1, 2, 4, 8, 16, 32):
+            calls, seconds = time_calls(
+                mixing.sum_blocks,
+                blocks[:inputs],
+                fmt.silence,
+                min_time=min_time,
+            )
+            yield result(
+                f'sum_blocks[{inputs}]', calls, seconds, backend=backend
+            )
+
+        calls, seconds = time_calls(
+            mixing.get_max_value, blocks[0], min_time=min_time
+        )
+        yield result('get_max_value', calls, seconds, backend=backend)
+
+    mixing.use(default)
+
+
+def bench_record_block(numblocks=4096):
+    block = noise_block()
+
+    def append():
+        tape = Tape(fmt.bytes_per_block)
+        for pos in range(numblocks):
+            record_block(tape, pos, block)
+
+    def overdub(tape):
+        for pos in range(numblocks):
+            record_block(tape, pos, block, offset=fmt.frame_size * 100)
+
+    def fill_gaps():
+        # Only every other chunk has been recorded on.
+        tape = Tape(fmt.bytes_per_block)
+        tape.write(numblocks - 1, fmt.silence)
+        for pos in range(0, numblocks, tape.blocks_per_chunk * 2):
+            tape.write(pos, block)
+        for pos in range(numblocks):
+            record_block(tape, pos, block)
+
+    tape = Tape(fmt.bytes_per_block)
+    tape.extend(block * numblocks)
+
+    for name, func, args in [
+        ('record_block append', append, ()),
+        ('record_block overdub', overdub, (tape,)),
+        ('record_block fill gaps', fill_gaps, ()),
+    ]:
+        calls, seconds = time_calls(func, *args)
+        yield result(name, calls * numblocks, seconds)
+
+
+def _time_io(megabytes):
+    """Time save and load of one file. Runs in a worker process."""
+    reset_peak_rss()
+    tape = make_tape(megabytes)
+    numblocks = len(tape)
+
+    formats = [(audio, 'wav'), (session, 'ovd')]
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for module, extension in formats:
+            filename = os.path.join(tmpdir, f'bench.{extension}')
+            start = time.perf_counter()
+            module.save(filename, tape, fmt)
+            seconds = time.perf_counter() - start
+            name = f'save {megabytes} MB {extension}'
+            results.append(result(name, 1, seconds, numblocks))
+
+        del tape
+        for module, extension in formats:
+            filename = os.path.join(tmpdir, f'bench.{extension}')
+            start = time.perf_counter()
+            module.load(filename, fmt)
+            seconds = time.perf_counter() - start
+            name = f'load {megabytes} MB {extension}'
+            results.append(result(name, 1, seconds, numblocks))
+
+    return results
+
+
+def bench_io(sizes):
+    context = multiprocessing.get_context('spawn')
+    for megabytes in sizes:
+        with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=context
+        ) as executor:
+            yield from executor.submit(_time_io, megabytes).result()
+
+
+def bench_callback(numblocks=2000):
+    """Time the audio callback with commands coming in every block."""
+    deck = None
+
+    def source():
+        block = noise_block()
+        for _ in range(numblocks):
+            deck.scrub(0.0)
+            deck.punch_in()
+            yield block
+
+    for layered in (False, True):
+        deck = make_deck(fmt, numblocks, layered=layered, source=source())
+        seconds = time_stream(deck)
+
+        name = 'callback layered' if layered else 'callback'
+        yield result(
+            name,
+            numblocks,
+            seconds,
+            load=seconds / numblocks / fmt.seconds_per_block,
+            dropped_commands=deck._commands.dropped,
+        )
+
+
+def run(sizes):
+    benchmarks = [
+        bench_mixing(),
+        bench_record_block(),
+        bench_callback(),
+        bench_io(sizes),
+    ]
+    for results in benchmarks:
+        for r in results:
+            backend = r.get('backend', '')
+            print(
+                f'{r["name"]:24} {backend:8}'
+                f' {r["ops_per_second"]:12.1f} ops/s'
+                f' {r["us_per_block"]:10.2f} us/block'
+                f' {r["peak_rss_mb"]:8.1f} MB',
+                flush=True,
+            )
+            yield r
+
+
+def result_key(r):
+    return (r['name'], r.get('backend'))
+
+
+def compare(old_filename, new_filename, threshold=0.1):
+    """Print the change in time per block between two result files."""
+    with open(old_filename) as infile:
+        old = {result_key(r): r for r in json.load(infile)['results']}
+    with open(new_filename) as infile:
+        new = json.load(infile)['results']
+
+    for r in new:
+        key = result_key(r)
+        if key not in old:
+            continue
+        change = r['us_per_block'] / old[key]['us_per_block'] - 1
+        flag = '  SLOWER' if change > threshold else ''
+        name = ' '.join(filter(None, key))
+        print(f'{name:34} {change:+8.1%}{flag}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes',
+        default='10,100',
+        metavar='MB,...',
+        help='file sizes for load and save (default 10,100)',
+    )
+    parser.add_argument(
+        '--output',
+        '-o',
+        default='bench_results.json',
+        metavar='FILE',
+        help='where to save results (default bench_results.json)',
+    )
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('OLD', 'NEW'),
+        help='compare two result files instead of running',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = list(run(sizes))
+
+    with open(args.output, 'w') as outfile:
+        json.dump(
+            dict(
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                machine=platform.machine(),
+                format=dict(
+                    frame_rate=fmt.frame_rate,
+                    channels=fmt.channels,
+                    frames_per_block=fmt.frames_per_block,
+                ),
+                results=results,
+            ),
+            outfile,
+            indent=2,
+        )
+    print(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
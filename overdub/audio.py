@@ -1,48 +1,71 @@
+import os
+import time
 import wave
-import array
-import sounddevice
+from dataclasses import dataclass
+from functools import cached_property
+from . import mixing
+from . import wavfile
+from .tape import Tape, MappedTape
 
 
-frame_rate = 44100
-frame_size = 4
 sample_size = 2
 
-frames_per_block = 1024
 
-bytes_per_block = frames_per_block * frame_size
-bytes_per_second = frame_rate * frame_size
-seconds_per_byte = 1 / bytes_per_second
-seconds_per_block = bytes_per_block * seconds_per_byte
-blocks_per_second = 1 / seconds_per_block
+@dataclass(frozen=True)
+class Format:
+    """Audio format. Samples are always 16 bit signed integers."""
 
-silence = b'\0' * bytes_per_block
+    frame_rate: int = 44100
+    channels: int = 2
+    frames_per_block: int = 1024
 
-min_sample = -32768
-max_sample = 32767
+    @property
+    def frame_size(self):
+        return self.channels * sample_size
 
-# Only works on little endian machines where 'h' is 16 bit.
-def add_blocks(blocka, blockb):
-    a = array.array('h')
-    a.frombytes(blocka)
+    @property
+    def bytes_per_block(self):
+        return self.frames_per_block * self.frame_size
+
+    @property
+    def seconds_per_block(self):
+        return self.frames_per_block / self.frame_rate
+
+    @property
+    def blocks_per_second(self):
+        return self.frame_rate / self.frames_per_block
+
+    @cached_property
+    def silence(self):
+        return bytes(self.bytes_per_block)
 
-    b = array.array('h')
-    b.frombytes(blockb)
+    def block2sec(self, numblocks):
+        return numblocks * self.seconds_per_block
 
-    s = array.array('h')
-    s.frombytes(blocka)
- 
-    for i in range(len(s)):
-        sum = a[i] + b[i]
-        if sum < min_sample:
-            sum = min_sample
-        elif sum > max_sample:
-            sum = max_sample
-        s[i] = sum
+    def sec2block(self, numsecs):
+        return int(round(numsecs * self.blocks_per_second))
 
-    return bytes(s.tobytes())
 
+default_format = Format()
 
-def sum_blocks(blocks):
+# The default format as module constants.
+frame_rate = default_format.frame_rate
+frame_size = default_format.frame_size
+frames_per_block = default_format.frames_per_block
+bytes_per_block = default_format.bytes_per_block
+seconds_per_block = default_format.seconds_per_block
+blocks_per_second = default_format.blocks_per_second
+silence = default_format.silence
+
+min_sample = mixing.min_sample
+max_sample = mixing.max_sample
+
+
+def add_blocks(blocka, blockb):
+    return mixing.add_blocks(blocka, blockb)
+
+
+def sum_blocks(blocks, fmt=default_format):
     """Return a block where with the sum of the samples on all blocks.
 
     Takes an interable of blocks (byte strings). If no blocks are passed
@@ -50,13 +73,7 @@ def sum_blocks(blocks):
 
     Treats None values as silent blocks.
     """
-    blocksum = silence
-
-    for block in blocks:
-        if block:
-            blocksum = add_blocks(blocksum, block)
-
-    return blocksum
+    return mixing.sum_blocks(blocks, fmt.silence)
 
 
 def get_max_value(block):
@@ -64,58 +81,231 @@ def get_max_value(block):
 
     The value is normalized to 0..1.
     """
-    arr = array.array('h')
-    arr.frombytes(block)
-
-    return max(max(arr), abs(min(arr))) / max_sample
+    return mixing.get_max_value(block) / max_sample
 
 
 def block2sec(numblocks):
-    return numblocks * seconds_per_block
+    return default_format.block2sec(numblocks)
 
 
 def sec2block(numsecs):
-    return int(round(numsecs * blocks_per_second))
+    return default_format.sec2block(numsecs)
+
+
+def read_format(filename, frames_per_block=frames_per_block):
+    """Return the Format of a WAV file."""
+    with wave.open(filename, 'r') as infile:
+        if infile.getsampwidth() != sample_size:
+            raise ValueError(f'{filename}: only 16 bit audio is supported')
+
+        return Format(
+            frame_rate=infile.getframerate(),
+            channels=infile.getnchannels(),
+            frames_per_block=frames_per_block,
+        )
+
+
+def _check_format(filename, infile, fmt):
+    actual = (
+        infile.getframerate(),
+        infile.getnchannels(),
+        infile.getsampwidth(),
+    )
+    if actual != (fmt.frame_rate, fmt.channels, sample_size):
+        raise ValueError(
+            f'{filename}: expected {fmt.frame_rate} Hz {fmt.channels} '
+            f'channel 16 bit audio'
+        )
 
 
-def load(filename):
-    """Read WAV file and return all data as a list of blocks."""
-    blocks = []
+def iter_load(filename, fmt=default_format, blocks_per_read=256):
+    """Read WAV file in large chunks.
+
+    Yields buffers of one or more whole blocks. The last one is padded
+    with silence. Raises ValueError if the file is not in format fmt.
+    """
+    frames_per_read = fmt.frames_per_block * blocks_per_read
+    bytes_per_block = fmt.bytes_per_block
 
     with wave.open(filename, 'r') as infile:
-        while block := infile.readframes(frames_per_block):
-            if len(block) < bytes_per_block:
-                block += silence[len(block) :]
-            blocks.append(block)
+        _check_format(filename, infile, fmt)
+
+        while data := infile.readframes(frames_per_read):
+            if len(data) % bytes_per_block:
+                padding = bytes_per_block - len(data) % bytes_per_block
+                data += fmt.silence[:padding]
+            yield memoryview(data)
+
+
+def iter_blocks(filename, fmt=default_format):
+    """Read WAV file and yield one block at a time."""
+    for data in iter_load(filename, fmt):
+        for start in range(0, len(data), fmt.bytes_per_block):
+            yield data[start : start + fmt.bytes_per_block]
+
+
+def load(filename, fmt=default_format, tape=None):
+    """Read WAV file and return all data as a tape.
+
+    The data is appended to tape if passed, otherwise to a new Tape.
+    """
+    if tape is None:
+        tape = Tape(fmt.bytes_per_block)
 
-    return blocks
+    for data in iter_load(filename, fmt):
+        tape.extend(data)
 
+    return tape
 
-def save(filename, blocks):
-    """Write a list of blocks to a WAV file."""
-    with wave.open(filename, 'w') as outfile:
-        outfile.setnchannels(2)
-        outfile.setsampwidth(sample_size)
-        outfile.setframerate(frame_rate)
 
-        for block in blocks:
-            outfile.writeframes(block)
+def open_mapped(filename, fmt=default_format):
+    """Open (or create) a WAV file as a memory mapped tape."""
+    return MappedTape(
+        filename,
+        fmt.bytes_per_block,
+        nchannels=fmt.channels,
+        sampwidth=sample_size,
+        framerate=fmt.frame_rate,
+    )
+
+
+def _make_header(fmt, data_size):
+    return wavfile.make_header(
+        fmt.channels, sample_size, fmt.frame_rate, data_size
+    )
+
+
+def save(filename, tape, fmt=default_format):
+    """Write a tape to a WAV file."""
+    data_size = len(tape) * fmt.bytes_per_block
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(_make_header(fmt, data_size))
+        outfile.writelines(tape.iter_chunks())
+
+
+def save_stream(filename, buffers, fmt=default_format):
+    """Write buffers of audio data to a WAV file.
+
+    The sizes in the header are filled in at the end, so the length
+    doesn't need to be known in advance.
+    """
+    with open(filename, 'wb') as outfile:
+        outfile.write(_make_header(fmt, 0))
+        data_size = 0
+        for data in buffers:
+            outfile.write(data)
+            data_size += len(data)
+        wavfile.write_sizes(outfile, wavfile.header_size, data_size)
+
+
+def _open_for_update(filename, fmt):
+    """Open WAV file for updating in place.
+
+    Returns (file, data_offset, data_size) or None if the file doesn't
+    exist or can't be updated in place.
+    """
+    try:
+        outfile = open(filename, 'r+b')
+    except FileNotFoundError:
+        return None
+
+    try:
+        *actual, data_offset, data_size = wavfile.read_header(outfile)
+    except wave.Error:
+        outfile.close()
+        return None
+
+    wanted = [fmt.channels, sample_size, fmt.frame_rate]
+    if actual != wanted or data_offset + data_size < os.path.getsize(filename):
+        outfile.close()
+        return None
+
+    return outfile, data_offset, data_size
+
+
+def save_changed(filename, tape, positions, fmt=default_format):
+    """Write changed blocks to a WAV file written earlier from the tape.
+
+    Blocks past the end of the file are always written and the file is
+    cut down if the tape is now shorter. Falls back to save() if the
+    file can't be updated in place.
+    """
+    opened = _open_for_update(filename, fmt)
+    if opened is None:
+        save(filename, tape, fmt)
+        return
+
+    outfile, data_offset, data_size = opened
+    bytes_per_block = fmt.bytes_per_block
+    old_length = data_size // bytes_per_block
+
+    positions = sorted(pos for pos in positions if pos < old_length)
+    positions.extend(range(old_length, len(tape)))
+
+    with outfile:
+        next_pos = None
+        for pos in positions:
+            if pos != next_pos:
+                outfile.seek(data_offset + pos * bytes_per_block)
+            outfile.write(tape.read(pos))
+            next_pos = pos + 1
+
+        data_size = len(tape) * bytes_per_block
+        wavfile.write_sizes(outfile, data_offset, data_size)
+        outfile.truncate(data_offset + data_size)
 
 
 class Stream:
-    def __init__(self, callback):
-        def callback_wrapper(inblock, outblock, *_):
+    """Audio stream using sounddevice.
+
+    Other stream backends (like offline.OfflineStream) take the same
+    arguments and have the same attributes and methods.
+    """
+
+    def __init__(
+        self, callback, fmt=default_format, latency='high', profiler=None
+    ):
+        import sounddevice
+
+        def callback_wrapper(inblock, outblock, frames, time_info, status):
+            start = time.perf_counter()
             outblock[:] = callback(bytes(inblock))
 
+            if profiler is not None:
+                end = time.perf_counter()
+                delay = time_info.outputBufferDacTime - time_info.currentTime
+                profiler.record(start, end, status, delay)
+
+        self.format = fmt
         self.stream = sounddevice.RawStream(
-            samplerate=frame_rate,
-            channels=2,
+            samplerate=fmt.frame_rate,
+            channels=fmt.channels,
             dtype='int16',
-            blocksize=frames_per_block,
+            blocksize=fmt.frames_per_block,
+            latency=latency,
             callback=callback_wrapper,
         )
         self.latency = sum(self.stream.latency)
-        self.play_ahead = int(round(self.latency * blocks_per_second))
+        self.latency_frames = int(round(self.latency * fmt.frame_rate))
+        self.device_key = self._get_device_key(latency)
+
+    def _get_device_key(self, latency):
+        """Return a string that identifies the devices and settings.
+
+        The latency setting is included since it changes the round trip
+        delay.
+        """
+        import sounddevice
+
+        devices = [sounddevice.query_devices(i) for i in self.stream.device]
+        names = [device['name'] for device in devices]
+        settings = [
+            self.format.frame_rate,
+            self.format.frames_per_block,
+            latency,
+        ]
+        return '|'.join(names + [str(value) for value in settings])
 
     def start(self):
         self.stream.start()
@@ -0,0 +1,237 @@
+"""Bounce files without audio hardware.
+
+Each input is mixed down (with --merge all inputs are mixed into one
+file), trailing silence is trimmed and the result is optionally
+normalized and written as WAV or as a session file. Files are
+processed in parallel by a pool of worker processes, and each one is
+streamed in chunks so memory use doesn't depend on the file length.
+
+    overdub bounce -o bounced/ takes/*.wav
+    overdub bounce --merge -o song.wav --normalize -1 take1.wav take2.wav
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+import dataclasses
+import concurrent.futures
+from typing import Optional, Tuple
+from . import audio
+from . import mixing
+from . import session
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+    inputs: Tuple[str, ...]
+    output: str
+    # Peak level to normalize to in dBFS, or None.
+    normalize: Optional[float] = None
+    trim: bool = True
+    # Blocks with no sample above this are silent (0..1).
+    threshold: float = 0.0
+
+
+def _get_module(filename):
+    return session if session.is_session_file(filename) else audio
+
+
+def read_format(filename):
+    return _get_module(filename).read_format(filename)
+
+
+def iter_mixed(filenames, fmt, blocks_per_chunk=256):
+    """Yield buffers of whole blocks with all the files mixed together.
+
+    Files are read in buffers of different sizes, for example session
+    files saved with another block size, so they are cut into pieces of
+    blocks_per_chunk blocks before they are mixed. Files that end early
+    are padded with silence.
+    """
+    size = fmt.bytes_per_block * blocks_per_chunk
+    readers = [
+        session.rechunk(_get_module(name).iter_load(name, fmt), size)
+        for name in filenames
+    ]
+    for buffers in itertools.zip_longest(*readers, fillvalue=b''):
+        size = max(len(data) for data in buffers)
+        buffers = [
+            bytes(data) + bytes(size - len(data)) if len(data) < size else data
+            for data in buffers
+            if len(data)
+        ]
+        yield mixing.sum_blocks(buffers, bytes(size))
+
+
+def scan(filenames, fmt, threshold=0):
+    """Return (peak, length) of the mix of filenames.
+
+    peak is the highest absolute sample value and length is the number
+    of blocks up to and including the last one that is not silent.
+    """
+    peak = 0
+    length = 0
+    pos = 0
+
+    for data in iter_mixed(filenames, fmt):
+        for block_peak in mixing.get_block_peaks(data, fmt.bytes_per_block):
+            pos += 1
+            if block_peak > threshold:
+                length = pos
+            peak = max(peak, block_peak)
+
+    return peak, length
+
+
+def iter_bounce(filenames, fmt, length, gain=1.0):
+    """Yield the first length blocks of the mix scaled by gain."""
+    remaining = length * fmt.bytes_per_block
+
+    for data in iter_mixed(filenames, fmt):
+        if remaining <= 0:
+            break
+        data = memoryview(data)[:remaining]
+        remaining -= len(data)
+
+        if gain != 1:
+            data = mixing.scale_block(data, gain)
+        yield data
+
+
+def bounce(job):
+    """Run a job. Returns (seconds of audio, bytes read, seconds taken)."""
+    start = time.perf_counter()
+    fmt = read_format(job.inputs[0])
+
+    threshold = job.threshold * mixing.max_sample if job.trim else -1
+    peak, length = scan(job.inputs, fmt, threshold)
+    if job.normalize is not None and peak > 0:
+        target = 10 ** (job.normalize / 20) * mixing.max_sample
+        gain = target / peak
+    else:
+        gain = 1.0
+
+    buffers = iter_bounce(job.inputs, fmt, length, gain)
+    _get_module(job.output).save_stream(job.output, buffers, fmt)
+
+    bytes_read = sum(os.path.getsize(name) for name in job.inputs)
+    seconds = fmt.block2sec(length)
+    return seconds, bytes_read, time.perf_counter() - start
+
+
+def _check_output(output, inputs):
+    if os.path.exists(output):
+        for filename in inputs:
+            if os.path.samefile(output, filename):
+                raise ValueError(f'{filename}: would be overwritten')
+
+
+def make_jobs(args):
+    options = dict(
+        normalize=args.normalize,
+        trim=not args.no_trim,
+        threshold=0.0,
+    )
+    if args.threshold is not None:
+        options['threshold'] = 10 ** (args.threshold / 20)
+
+    if args.merge:
+        _check_output(args.output, args.inputs)
+        return [Job(tuple(args.inputs), args.output, **options)]
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = []
+    for filename in args.inputs:
+        stem, _ = os.path.splitext(os.path.basename(filename))
+        output = os.path.join(args.output, f'{stem}.{args.format}')
+        _check_output(output, [filename])
+        jobs.append(Job((filename,), output, **options))
+    return jobs
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='overdub bounce',
+        description='Mix down, trim and normalize files in bulk.',
+    )
+    arg = parser.add_argument
+
+    arg('inputs', nargs='+', metavar='FILE', help='WAV or .ovd files')
+    arg(
+        '-o',
+        '--output',
+        required=True,
+        metavar='PATH',
+        help='output directory (output file with --merge)',
+    )
+    arg('--merge', action='store_true', help='mix all inputs into one file')
+    arg(
+        '--format',
+        choices=['wav', 'ovd'],
+        default='wav',
+        help='output format when not merging (default wav)',
+    )
+    arg(
+        '--normalize',
+        type=float,
+        nargs='?',
+        const=-1.0,
+        metavar='DBFS',
+        help='scale to this peak level (default -1 dBFS)',
+    )
+    arg('--no-trim', action='store_true', help='keep trailing silence')
+    arg(
+        '--threshold',
+        type=float,
+        metavar='DBFS',
+        help='treat blocks below this level as silence when trimming',
+    )
+    arg('--jobs', '-j', type=int, help='worker processes (default: all CPUs)')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        jobs = make_jobs(args)
+    except ValueError as error:
+        sys.exit(f'error: {error}')
+
+    failed = 0
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        futures = {executor.submit(bounce, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                seconds, bytes_read, elapsed = future.result()
+            except Exception as error:
+                # Codec errors from zlib or lzma fail one file, not all.
+                name = type(error).__qualname__
+                if type(error).__module__ != 'builtins':
+                    # zlib.error rather than just error.
+                    name = f'{type(error).__module__}.{name}'
+                print(
+                    f'{job.output}: failed: {name}: {error}', file=sys.stderr
+                )
+                failed += 1
+                continue
+
+            speed = seconds / elapsed if elapsed else 0
+            megabytes = bytes_read / 2**20 / elapsed if elapsed else 0
+            print(
+                f'{job.output}: {seconds:.1f} s of audio in {elapsed:.2f} s '
+                f'({speed:.0f}x realtime, {megabytes:.1f} MB/s)',
+                flush=True,
+            )
+
+    elapsed = time.perf_counter() - start
+    print(f'{len(jobs) - failed} of {len(jobs)} files in {elapsed:.1f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
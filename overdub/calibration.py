@@ -0,0 +1,130 @@
+"""Round trip latency calibration.
+
+Connect the output to the input (with a cable or by placing a
+microphone in front of a speaker) and run ``overdub --calibrate``. A
+short pulse is played and the recorded input is cross-correlated with
+it to find the delay in frames. The delay is stored per device and
+used to line up overdubs.
+"""
+import os
+import json
+import math
+import array
+import threading
+import statistics
+from . import audio
+from . import config
+from .mixing import numpy
+
+
+def config_filename():
+    return config.config_filename('latency.json')
+
+
+def load_offsets():
+    try:
+        with open(config_filename()) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {}
+
+
+def get_offset(device_key):
+    """Return calibrated latency in frames for device, or None."""
+    return load_offsets().get(device_key)
+
+
+def save_offset(device_key, frames):
+    offsets = load_offsets()
+    offsets[device_key] = frames
+
+    filename = config_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as outfile:
+        json.dump(offsets, outfile, indent=2, sort_keys=True)
+
+
+def make_pulse(length=32, amplitude=0.8):
+    """Return a half sine pulse as a list of samples."""
+    peak = amplitude * audio.max_sample
+    return [int(peak * math.sin(math.pi * i / length)) for i in range(length)]
+
+
+def find_delay(signal, pulse):
+    """Return the index in signal where pulse matches best."""
+    if numpy is not None:
+        corr = numpy.correlate(
+            numpy.asarray(signal, numpy.float64),
+            numpy.asarray(pulse, numpy.float64),
+            'valid',
+        )
+        return int(numpy.argmax(numpy.abs(corr)))
+
+    best_index = 0
+    best_value = 0
+    for i in range(len(signal) - len(pulse) + 1):
+        value = abs(sum(a * b for a, b in zip(signal[i:], pulse)))
+        if value > best_value:
+            best_index = i
+            best_value = value
+
+    return best_index
+
+
+def measure(
+    fmt=audio.default_format, latency='high', seconds=1, lead_blocks=4
+):
+    """Play a pulse and return (frames, device_key).
+
+    frames is the round trip delay.
+    """
+    pulse = make_pulse()
+    outblock = array.array('h', fmt.silence)
+    for channel in range(fmt.channels):
+        end = len(pulse) * fmt.channels
+        outblock[channel : end : fmt.channels] = array.array('h', pulse)
+    outblock = outblock.tobytes()
+
+    numblocks = lead_blocks + fmt.sec2block(seconds)
+    inblocks = []
+    done = threading.Event()
+
+    def callback(inblock):
+        inblocks.append(inblock)
+        if len(inblocks) == numblocks:
+            done.set()
+
+        if len(inblocks) == lead_blocks + 1:
+            return outblock
+        else:
+            return fmt.silence
+
+    stream = audio.Stream(callback, fmt, latency)
+    stream.start()
+    try:
+        done.wait(seconds * 5)
+    finally:
+        stream.stop()
+
+    # Use the left channel.
+    signal = array.array('h', b''.join(inblocks))[:: fmt.channels]
+    if max(map(abs, signal), default=0) < audio.max_sample * 0.05:
+        raise RuntimeError('pulse not picked up (is output looped to input?)')
+
+    index = find_delay(signal, pulse)
+    return index - lead_blocks * fmt.frames_per_block, stream.device_key
+
+
+def calibrate(fmt=audio.default_format, latency='high', repeats=3):
+    """Measure latency a few times and store the median.
+
+    Returns (device_key, frames).
+    """
+    delays = []
+    for _ in range(repeats):
+        frames, device_key = measure(fmt, latency)
+        delays.append(frames)
+
+    frames = int(statistics.median(delays))
+    save_offset(device_key, frames)
+    return device_key, frames
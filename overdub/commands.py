@@ -0,0 +1,69 @@
+import threading
+
+
+class CommandRing:
+    """Fixed size ring of commands to run in the audio callback.
+
+    Each command is an opcode (a function) and a tuple of arguments,
+    stored in preallocated records. Producers take a lock among
+    themselves, but the audio callback never does.
+
+    Coalesced commands are not queued. Only the arguments of the latest
+    call are kept, and they are applied after the queued commands.
+    """
+
+    def __init__(self, size=256, max_drain=64):
+        self.size = size
+        self.max_drain = max_drain
+
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._records = [[None, None] for _ in range(size)]
+        self._head = 0
+        self._tail = 0
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def put(self, opcode, args):
+        """Queue a command. Returns False if the ring was full."""
+        with self._lock:
+            if self._head - self._tail >= self.size:
+                self.dropped += 1
+                return False
+
+            record = self._records[self._head % self.size]
+            record[0] = opcode
+            record[1] = args
+            self._head += 1
+            return True
+
+    def put_latest(self, opcode, args):
+        """Replace any pending call to opcode with this one."""
+        with self._lock:
+            if opcode in self._latest:
+                self.coalesced += 1
+            self._latest[opcode] = args
+
+    def drain(self):
+        """Run pending commands. Called from the audio callback.
+
+        At most max_drain queued commands are run. The rest are left for
+        the next callback.
+        """
+        for _ in range(self.max_drain):
+            if self._tail == self._head:
+                break
+
+            record = self._records[self._tail % self.size]
+            opcode, args = record
+            record[1] = None
+            self._tail += 1
+            opcode(*args)
+
+        while self._latest:
+            try:
+                opcode, args = self._latest.popitem()
+            except KeyError:
+                break
+            opcode(*args)
@@ -0,0 +1,9 @@
+import os
+
+
+def config_filename(name):
+    """Return path of a file in the user's overdub config directory."""
+    config_dir = os.environ.get(
+        'XDG_CONFIG_HOME', os.path.expanduser('~/.config')
+    )
+    return os.path.join(config_dir, 'overdub', name)
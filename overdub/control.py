@@ -0,0 +1,315 @@
+"""Remote control over a Unix socket.
+
+The protocol is one JSON object per line. A request looks like::
+
+    {"cmd": "goto", "args": [12.5], "id": 1}
+
+and gets a reply with "ok" (and "error" if it's false). "id" is
+optional and is copied to the reply. Besides the transport commands
+there are "status", which replies with the current status, and
+"watch" and "unwatch", which start and stop status pushes. Pushes look
+like {"status": {...}} and are sent at most rate times per second,
+only when something has changed.
+
+All clients are served by one thread running an asyncio event loop.
+
+To try it out:
+
+    python -m overdub.control play
+    python -m overdub.control goto 10
+    python -m overdub.control watch
+"""
+import os
+import sys
+import json
+import math
+import socket
+import asyncio
+import argparse
+import threading
+import dataclasses
+from .threads import start_thread
+from .status import Status
+from .status_line import format_status
+
+# Deck methods that can be called and the types of their arguments.
+commands = {
+    'play': (),
+    'stop': (),
+    'record': (),
+    'toggle_play': (),
+    'toggle_record': (),
+    'punch_in': (),
+    'punch_out': (),
+    'undo': (),
+    'redo': (),
+    'goto': (float,),
+    'skip': (float,),
+    'scrub': (float,),
+    'set_loop': (float, float),
+    'clear_loop': (),
+    'mark_loop_start': (),
+    'mark_loop_end': (),
+    'set_track_gain': (int, float),
+    'toggle_track_mute': (int,),
+}
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'overdub.sock')
+    else:
+        return f'/tmp/overdub-{os.getuid()}.sock'
+
+
+def _encode(message):
+    return json.dumps(message).encode() + b'\n'
+
+
+def _is_number(value):
+    # json.loads() accepts NaN and Infinity.
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and math.isfinite(value)
+    )
+
+
+class ControlServer:
+    def __init__(self, deck, path=None, rate=10, max_buffer=64 * 1024):
+        """rate is the maximum number of status pushes per second.
+
+        Pushes to a client are skipped while more than max_buffer bytes
+        are waiting to be sent to it.
+        """
+        self.deck = deck
+        self.path = path or default_socket_path()
+        self.rate = rate
+        self.max_buffer = max_buffer
+
+        # Client writers and the tasks serving them.
+        self._clients = {}
+        self._watchers = set()
+        self._subscription = None
+        self._loop = None
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        """Start serving in a background thread."""
+        ready = threading.Event()
+
+        def run():
+            try:
+                asyncio.run(self._serve(ready))
+            except Exception as error:
+                self._error = error
+                ready.set()
+
+        self._thread = start_thread(run)
+        ready.wait()
+        if self._error:
+            raise self._error
+
+    def stop(self):
+        """Stop the server. Call this after the deck's stream has stopped."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join()
+            self._loop = None
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(self.path)
+            except ConnectionRefusedError:
+                os.remove(self.path)
+            else:
+                raise RuntimeError(f'{self.path} is in use')
+
+    async def _serve(self, ready):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._changed = asyncio.Event()
+
+        self._remove_stale_socket()
+        server = await asyncio.start_unix_server(
+            self._handle_client, self.path
+        )
+        os.chmod(self.path, 0o600)
+
+        notifier = self.deck.notifier
+        self._subscription = notifier.subscribe(ticks_per_second=self.rate)
+        self._loop.add_reader(self._subscription, self._on_change)
+        pusher = asyncio.create_task(self._push_status())
+        ready.set()
+
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            self._loop.remove_reader(self._subscription)
+            notifier.unsubscribe(self._subscription)
+            pusher.cancel()
+            # Closing the connections lets the client tasks finish.
+            for writer in self._clients:
+                writer.close()
+            await asyncio.gather(*self._clients.values())
+            os.remove(self.path)
+
+    def _on_change(self):
+        self._subscription.clear()
+        self._changed.set()
+
+    def _get_status(self):
+        return dataclasses.asdict(self.deck.get_status())
+
+    async def _push_status(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+
+            if self._watchers:
+                line = _encode({'status': self._get_status()})
+                for writer in self._watchers:
+                    size = writer.transport.get_write_buffer_size()
+                    if size <= self.max_buffer:
+                        writer.write(line)
+
+            # Changes in the meantime are pushed together.
+            await asyncio.sleep(1 / self.rate)
+
+    async def _handle_client(self, reader, writer):
+        self._clients[writer] = asyncio.current_task()
+        try:
+            while line := await reader.readline():
+                writer.write(_encode(self._run(line, writer)))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # ValueError is raised for lines that are too long.
+            pass
+        finally:
+            self._watchers.discard(writer)
+            del self._clients[writer]
+            writer.close()
+
+    def _run(self, line, writer):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'ok': False, 'error': 'invalid JSON'}
+
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'request must be an object'}
+
+        reply = {'ok': True}
+        if 'id' in request:
+            reply['id'] = request['id']
+
+        cmd = request.get('cmd')
+        args = request.get('args', [])
+
+        if cmd == 'status':
+            reply['status'] = self._get_status()
+        elif cmd == 'watch':
+            self._watchers.add(writer)
+            self._changed.set()
+        elif cmd == 'unwatch':
+            self._watchers.discard(writer)
+        elif cmd in commands:
+            types = commands[cmd]
+            if not isinstance(args, list) or len(args) != len(types):
+                reply.update(ok=False, error=f'{cmd} takes {len(types)} args')
+            elif not all(map(_is_number, args)):
+                reply.update(ok=False, error='args must be finite numbers')
+            else:
+                try:
+                    getattr(self.deck, cmd)(*args)
+                except ValueError as error:
+                    reply.update(ok=False, error=str(error))
+        else:
+            reply.update(ok=False, error=f'unknown command {cmd!r}')
+
+        return reply
+
+
+class Client:
+    """Blocking client for scripts."""
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(path or default_socket_path())
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def _read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('server closed the connection')
+        return json.loads(line)
+
+    def send(self, cmd, *args):
+        """Send a command and return the reply."""
+        self.file.write(_encode({'cmd': cmd, 'args': list(args)}))
+        self.file.flush()
+
+        while 'status' in (reply := self._read()) and 'ok' not in reply:
+            # Skip status pushes.
+            pass
+        if not reply['ok']:
+            raise ValueError(reply['error'])
+        return reply
+
+    def get_status(self):
+        return Status(**self.send('status')['status'])
+
+    def watch(self):
+        """Yield Status objects as they are pushed."""
+        self.send('watch')
+        while True:
+            message = self._read()
+            if 'status' in message and 'ok' not in message:
+                yield Status(**message['status'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m overdub.control',
+        description='Send a command to a running overdub.',
+    )
+    parser.add_argument('--socket', metavar='PATH', help='socket path')
+    parser.add_argument(
+        'cmd', choices=sorted(commands) + ['status', 'watch']
+    )
+    parser.add_argument('args', nargs='*', type=float)
+    args = parser.parse_args()
+
+    client = Client(args.socket)
+    try:
+        if args.cmd == 'status':
+            print(format_status(client.get_status()))
+        elif args.cmd == 'watch':
+            for status in client.watch():
+                print(format_status(status), flush=True)
+        else:
+            client.send(args.cmd, *args.args)
+    except ValueError as error:
+        sys.exit(f'error: {error}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
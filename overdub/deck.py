@@ -1,92 +1,374 @@
-import queue
+import os
+import time
 import functools
 from . import audio
+from . import calibration
+from . import session
 from .status import Status
+from .commands import CommandRing
+from .journal import Journal
+from .layers import Mixdown
+from .history import History, Pass, TrackPass
+from .meter import Meter
+from .notifier import StatusNotifier
+from .overview import Overview
+from .profiler import CallbackProfiler
+from .tape import Tape, MappedTape, SparseTape
+from .varispeed import Varispeed, max_rate
+
+# Scrub speeds closer to zero than this are taken as zero.
+scrub_dead_zone = 0.05
+# Furthest time on the tape that can be jumped to.
+max_seconds = 24 * 60 * 60
+
+
+def play_block(tape, pos):
+    return tape.read(pos)
+
+
+def record_block(tape, pos, block, offset=0):
+    """Mix block into tape at pos.
+
+    If offset is given the block starts that many bytes into pos and
+    whatever doesn't fit goes into the next block. The block can be
+    shorter than a full block.
+    """
+    if offset == 0:
+        if pos >= 0:
+            tape.mix(pos, block)
+    else:
+        split = tape.bytes_per_block - offset
+        block = memoryview(block)
+        if pos >= 0:
+            tape.mix(pos, block[:split], offset)
+        if len(block) > split and pos + 1 >= 0:
+            tape.mix(pos + 1, block[split:])
 
 
-def play_block(blocks, pos):
-    if 0 <= pos < len(blocks):
-        return blocks[pos]
-    else:
-        return audio.silence
+def in_callback(method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        self._commands.put(method, (self,) + args)
 
+    return wrapper
 
-def record_block(blocks, pos, block):
-    if pos < 0:
-        return
-    elif pos < len(blocks):
-        blocks[pos] = audio.sum_blocks([blocks[pos], block])
-    elif pos == len(blocks):
-        blocks.append(block)
-    else:
-        gap = pos - len(blocks)
-        blocks.extend([audio.silence] * gap)
-        blocks.append(block)
 
+def coalesced_in_callback(method):
+    """Like in_callback() but only the latest pending call is run."""
 
-def in_callback(method):
     @functools.wraps(method)
-    def wrapper(self, *args, **kwargs):
-        def func():
-            return method(self, *args, **kwargs)
-
-        return self._command_queue.put(func)
+    def wrapper(self, *args):
+        self._commands.put_latest(method, (self,) + args)
 
     return wrapper
 
 
 class Deck:
-    def __init__(self):
+    def __init__(
+        self,
+        fmt=audio.default_format,
+        latency='high',
+        mapped=False,
+        layered=False,
+        sparse=False,
+        dedup=False,
+        undo_memory=256 * 2**20,
+        trace_filename=None,
+        backend=audio.Stream,
+    ):
+        if mapped and layered:
+            raise ValueError('layered decks can not be memory mapped')
+
+        self.format = fmt
+        self.mapped = mapped
+        self.layered = layered
         self.pos = 0
+        # Frames into the block at pos. Only non-zero after a loop wrap
+        # that didn't fall on a block boundary.
+        self.offset = 0
         self.mode = 'stopped'
         self.solo = False
-        self.scrub = 0.0
-        self.meter = 0
+        self.scrub_speed = 0.0
+        # Fractional frame position while scrubbing.
+        self._scrub_frame = None
+        self.meter = Meter(fmt)
+        self.notifier = StatusNotifier(fmt)
+
+        # Sparse tapes only store blocks that are not silent.
+        if sparse or dedup:
+            self.make_tape = functools.partial(SparseTape, dedup=dedup)
+        else:
+            self.make_tape = Tape
 
-        self.blocks = []
+        if layered:
+            self.tape = Mixdown(fmt.bytes_per_block, self.make_tape)
+        else:
+            self.tape = self.make_tape(fmt.bytes_per_block)
+        self.overview = Overview(fmt.bytes_per_block)
+        self.varispeed = Varispeed(fmt)
+        self._journal = None
+        self.history = History(max_bytes=undo_memory)
+        # Undo or redo in progress.
+        self._restoring = None
+        # The track that is being recorded in layered mode.
+        self._track = None
+        # [start, end) block ranges recorded by the current or last pass.
+        self.pass_regions = []
+
+        # (start, end) frames to cycle between, or None.
+        self.loop = None
+        self._loop_mark = 0
+        # True once playback has wrapped around the current loop.
+        self._wrapped = False
+        # Next frame to record to during a pass.
+        self._rec_frame = None
+        # The recording reached the loop end and the next block starts
+        # a new pass.
+        self._layer_done = False
+        self._outblock = bytearray(fmt.bytes_per_block)
+
+        self.profiler = CallbackProfiler(
+            fmt.seconds_per_block, trace=trace_filename is not None
+        )
+        self._trace_filename = trace_filename
+        self._stream = backend(
+            self._audio_callback, fmt, latency, self.profiler
+        )
 
-        self._stream = audio.Stream(self._audio_callback)
+        # Round trip latency in frames. Recordings are moved back by this
+        # much so they line up with what was played.
+        self.latency_frames = calibration.get_offset(self._stream.device_key)
+        if self.latency_frames is None:
+            self.latency_frames = self._stream.latency_frames
 
-        self._command_queue = queue.Queue()
+        self._commands = CommandRing()
 
     def start_stream(self):
+        if self.layered:
+            self.tape.start_prefetch(
+                self._get_prefetch_positions,
+                lookahead=self.format.sec2block(2),
+                interval=self.format.seconds_per_block * 2,
+            )
+        self.varispeed.start(
+            self._read_mixed, lambda: len(self.tape), lambda: self.pos
+        )
         self._stream.start()
 
+    def _get_prefetch_positions(self):
+        # The loop start is mixed ahead too so the wrap finds it ready.
+        loop = self.loop
+        if loop:
+            return [self.pos, loop[0] // self.format.frames_per_block]
+        else:
+            return [self.pos]
+
     def stop_stream(self):
         self._stream.stop()
+        if self._trace_filename:
+            self.profiler.dump_trace(self._trace_filename)
+        if self.layered:
+            self.tape.stop_prefetch()
+        self.varispeed.stop()
 
     def load(self, filename):
-        self.blocks = audio.load(filename)
+        """Load a WAV file, or a session file if it ends in .ovd."""
+        if self.mapped:
+            if session.is_session_file(filename):
+                raise ValueError(f'{filename}: only WAV files can be mapped')
+            self.tape = audio.open_mapped(filename, self.format)
+            # Reading the whole file would undo the quick open.
+            self.overview.rebuild_later(self.tape)
+            self.varispeed.mark_dirty(0, len(self.tape))
+            return
+
+        tape = self._load_tape(filename)
+        if self.layered:
+            self.tape = Mixdown(self.format.bytes_per_block, self.make_tape)
+            self.tape.add_track(tape)
+        else:
+            self.tape = tape
+
+        if isinstance(tape, session.SessionTape):
+            # Saved peaks spare decoding the whole file.
+            self.overview.rebuild(self.tape, tape.peaks)
+        else:
+            self.overview.rebuild(self.tape)
+        self.varispeed.mark_dirty(0, len(self.tape))
+
+    def _load_tape(self, filename):
+        if not session.is_session_file(filename):
+            tape = self.make_tape(self.format.bytes_per_block)
+            return audio.load(filename, self.format, tape)
+        elif self.make_tape is Tape:
+            return session.open_tape(filename, self.format)
+        else:
+            tape = self.make_tape(self.format.bytes_per_block)
+            return session.load(filename, self.format, tape)
+
+    def start_autosave(self, filename):
+        """Journal changes to disk in the background.
+
+        Any journal left behind by a crash is replayed onto the tape.
+        Memory mapped tapes are already written in place. Layered decks
+        are not journaled.
+        """
+        if not (self.layered or isinstance(self.tape, MappedTape)):
+            if session.is_session_file(filename):
+                save_changed = session.save_changed
+            else:
+                save_changed = audio.save_changed
+            self._journal = Journal(
+                self.tape,
+                filename,
+                self.format,
+                save_changed=save_changed,
+                on_change=self._mark_range_dirty,
+            )
 
     def save(self, filename):
-        audio.save(filename, self.blocks)
+        if self._is_mapped_to(filename):
+            self.tape.flush()
+        elif self._journal and self._journal.filename == filename:
+            self._journal.save()
+        elif session.is_session_file(filename):
+            session.save(filename, self.tape, self.format)
+        else:
+            audio.save(filename, self.tape, self.format)
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+        if isinstance(self.tape, MappedTape):
+            self.tape.close()
+
+    def _is_mapped_to(self, filename):
+        return isinstance(self.tape, MappedTape) and os.path.samefile(
+            self.tape.filename, filename
+        )
 
     def get_status(self):
         return Status(
-            time=audio.block2sec(self.pos),
-            end=audio.block2sec(len(self.blocks)),
+            time=self.format.block2sec(self.pos),
+            end=self.format.block2sec(len(self.tape)),
             mode=self.mode,
             solo=self.solo,
-            meter=self.meter,
+            meter=self.meter.peak,
+            peaks=tuple(self.meter.peaks),
+            rms=tuple(self.meter.rms),
+            dropped_commands=self._commands.dropped,
+            coalesced_commands=self._commands.coalesced,
+            callback_max=self.profiler.window_max(),
+            callback_load=self.profiler.load(),
+            callback_histogram=tuple(self.profiler.histogram),
+            drain_time=self.profiler.drain_time,
+            xruns=self.profiler.xruns,
+            loop=self._get_loop_seconds(),
         )
 
-    @in_callback
+    def _get_loop_seconds(self):
+        loop = self.loop
+        if loop:
+            return tuple(frame / self.format.frame_rate for frame in loop)
+        else:
+            return ()
+
+    def update_overview(self):
+        """Bring the peak overview up to date.
+
+        Call this from the UI thread before drawing. Returns the set of
+        blocks that changed.
+        """
+        return self.overview.refresh(self._read_mixed, len(self.tape))
+
+    def _read_mixed(self, pos):
+        # Safe to call from other threads.
+        if self.layered:
+            return self.tape.read_mixed(pos)
+        else:
+            return self.tape.read(pos)
+
     def goto(self, seconds):
-        self.pos = max(0, audio.sec2block(seconds))
-        if self.mode == 'recording':
-            self.mode = 'playing'
+        self._goto(self._check_time(seconds))
 
-    @in_callback
     def skip(self, seconds):
-        self.pos = max(0, self.pos + audio.sec2block(seconds))
+        self._skip(self._check_time(seconds))
+
+    def set_loop(self, start, end):
+        """Cycle between start and end (in seconds)."""
+        self._set_loop_seconds(self._check_time(start), self._check_time(end))
+
+    def _check_time(self, seconds):
+        # Times far off the tape would overflow or fill memory in the
+        # audio callback.
+        if not -max_seconds <= seconds <= max_seconds:
+            raise ValueError(f'time must be within {max_seconds} seconds')
+        return seconds
+
+    @in_callback
+    def _goto(self, seconds):
+        self._jump_to(self.format.sec2block(seconds))
+
+    @in_callback
+    def _skip(self, seconds):
+        self._jump_to(self.pos + self.format.sec2block(seconds))
+
+    @in_callback
+    def _set_loop_seconds(self, start, end):
+        start = max(0, round(start * self.format.frame_rate))
+        end = round(end * self.format.frame_rate)
+        self._set_loop(start, end)
+
+    @in_callback
+    def mark_loop_start(self):
+        self._loop_mark = self._get_frame()
+
+    @in_callback
+    def mark_loop_end(self):
+        """Cycle between the loop start mark and the play position."""
+        self._set_loop(self._loop_mark, self._get_frame())
+
+    @in_callback
+    def clear_loop(self):
+        self._set_loop(0, 0)
+
+    def _set_loop(self, start, end):
+        if end > start:
+            self.loop = (start, end)
+        else:
+            self.loop = None
+        self._wrapped = False
+        if self.history.current is not None:
+            # Recording goes on from the play position in a new pass.
+            self._end_pass()
+
+    def _jump_to(self, pos):
+        max_pos = self.format.sec2block(max_seconds)
+        self.pos = min(max(0, pos), max_pos)
+        self.offset = 0
+        self._wrapped = False
+        self._scrub_frame = None
+
+        # A pass only covers one stretch of tape, so a jump ends it even
+        # if recording is turned back on before the next block.
         if self.mode == 'recording':
             self.mode = 'playing'
+        if self.history.current is not None:
+            self._end_pass()
 
-    @in_callback
+    @coalesced_in_callback
     def scrub(self, speed):
+        """Play at speed times normal speed on top of normal playback.
+
+        Negative speeds play backwards. Scrubbing stops recording.
+        """
+        if abs(speed) < scrub_dead_zone:
+            speed = 0.0
         if speed != 0 and self.mode == 'recording':
             self.mode = 'playing'
-        self.scrub = speed
+        self.scrub_speed = speed
 
     @in_callback
     def toggle_play(self):
@@ -125,45 +407,286 @@ class Deck:
         if self.mode == 'recording':
             self.mode = 'playing'
 
-    def _update_meter(self, block):
-        to_zero_per_second = 2
-        fall = audio.block2sec(to_zero_per_second)
-        self.meter = max(self.meter - fall, audio.get_max_value(block))
-
-    def _handle_commands(self):
-        while True:
-            try:
-                func = self._command_queue.get_nowait()
-            except queue.Empty:
-                return
-            else:
-                func()
+    def set_track_gain(self, index, gain):
+        """Set the gain of a layer (0 is the first one recorded)."""
+        self._set_track_gain(self._check_track(index), gain)
 
-    def _audio_callback(self, inblock):
-        self._handle_commands()
+    def toggle_track_mute(self, index):
+        self._toggle_track_mute(self._check_track(index))
+
+    def _check_track(self, index):
+        if not self.layered:
+            raise ValueError('tracks need a layered deck')
+        if index not in range(len(self.tape.tracks)):
+            raise ValueError(f'no track {index}')
+        return int(index)
+
+    # The track may be undone before the command runs.
+
+    @in_callback
+    def _set_track_gain(self, index, gain):
+        if index < len(self.tape.tracks):
+            self.tape.set_gain(index, gain)
+            self._mark_range_dirty(0, len(self.tape.tracks[index].tape))
+
+    @in_callback
+    def _toggle_track_mute(self, index):
+        if index < len(self.tape.tracks):
+            self.tape.set_mute(index, not self.tape.tracks[index].mute)
+            self._mark_range_dirty(0, len(self.tape.tracks[index].tape))
+
+    @in_callback
+    def undo(self):
+        self._start_restore(self.history.pop_undo())
+
+    @in_callback
+    def redo(self):
+        self._start_restore(self.history.pop_redo())
+
+    def _start_restore(self, entry):
+        self._finish_restore()
+        if self.mode == 'recording':
+            self.mode = 'playing'
+            self._end_pass()
+
+        self.pass_regions = []
+        if isinstance(entry, TrackPass):
+            self._mark_range_dirty(0, len(entry.track.tape))
+
+        if entry is not None:
+            # Undo a few blocks per callback to avoid dropouts.
+            self._restoring = entry.swap(
+                self.tape, batch_size=32, on_change=self._mark_dirty
+            )
+
+    def _step_restore(self):
+        try:
+            next(self._restoring)
+        except StopIteration:
+            self._restoring = None
+            self.history.recount()
+
+    def _finish_restore(self):
+        while self._restoring:
+            self._step_restore()
+
+    def _begin_pass(self):
+        self._finish_restore()
+        # Replaced instead of cleared since the UI reads it.
+        self.pass_regions = []
+        if self.layered:
+            self._track = self.tape.add_track()
+            self.history.begin(TrackPass(self._track))
+        else:
+            self.history.begin(Pass(len(self.tape)))
+
+    def _end_pass(self):
+        self.history.end()
+        self._track = None
+        self._rec_frame = None
+        self._layer_done = False
+
+    def _mark_range_dirty(self, start, end=None):
+        # Doesn't touch the journal, so it's also used for replays.
+        self.overview.mark_dirty(start, end)
+        self.varispeed.mark_dirty(start, end)
+
+    def _mark_dirty(self, pos):
+        self.overview.mark_dirty(pos)
+        self.varispeed.mark_dirty(pos)
+        if self._journal:
+            self._journal.mark_dirty(pos)
+
+    def _add_to_pass_regions(self, pos):
+        regions = self.pass_regions
+        if regions and regions[-1][0] <= pos <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], pos + 1)
+        else:
+            regions.append([pos, pos + 1])
 
-        if self.scrub != 0:
-            self.pos += int(round(self.scrub))
-            if self.pos < 0:
-                self.pos = 0
+    def _record(self, frame, block):
+        pos, offset = divmod(frame, self.format.frames_per_block)
+        offset *= self.format.frame_size
+        last = pos + (offset + len(block) - 1) // self.format.bytes_per_block
 
-        if (self.mode != 'stopped' or self.scrub) and not self.solo:
-            outblock = play_block(self.blocks, self.pos)
+        touched = range(max(pos, 0), last + 1)
+        if self.layered:
+            # Each recording pass goes into a new track.
+            record_block(self._track.tape, pos, block, offset)
         else:
-            outblock = audio.silence
+            for i in touched:
+                self.history.save(self.tape, i)
+            record_block(self.tape, pos, block, offset)
+
+        # Marked after writing so the journal and the mixdown get the
+        # new data.
+        for i in touched:
+            if self.layered:
+                self.tape.invalidate(i)
+            self._mark_dirty(i)
+            self._add_to_pass_regions(i)
+
+    def _get_frame(self):
+        return self.pos * self.format.frames_per_block + self.offset
+
+    def _split_at_loop(self, frame, count):
+        """Split count frames from frame into (frame, count) segments.
+
+        When a segment reaches the loop end the next one starts at the
+        loop start. Returns the segments and the frame after them.
+        """
+        segments = []
+        while count > 0:
+            size = count
+            if self.loop:
+                start, end = self.loop
+                if frame < end < frame + size:
+                    size = end - frame
+            segments.append((frame, size))
+            frame += size
+            count -= size
+            if self.loop and frame == self.loop[1]:
+                frame = self.loop[0]
+        return segments, frame
+
+    def _read_segments(self, segments):
+        """Copy segments of the tape into one output block."""
+        frames_per_block = self.format.frames_per_block
+        frame_size = self.format.frame_size
+        out = self._outblock
+        i = 0
+        for frame, count in segments:
+            while count > 0:
+                pos, offset = divmod(frame, frames_per_block)
+                size = min(count, frames_per_block - offset)
+                block = play_block(self.tape, pos)
+                start = offset * frame_size
+                length = size * frame_size
+                out[i : i + length] = block[start : start + length]
+                i += length
+                frame += size
+                count -= size
+        return out
+
+    def _record_segments(self, inblock):
+        if self._rec_frame is None:
+            # Start of a pass. If it starts inside a loop that has
+            # already wrapped, the latency adjustment wraps too.
+            frame = self._get_frame()
+            recframe = frame - self.latency_frames
+            if self.loop and self._wrapped:
+                start, end = self.loop
+                if recframe < start <= frame < end:
+                    recframe = start + (recframe - start) % (end - start)
+            self._rec_frame = recframe
+
+        segments, next_frame = self._split_at_loop(
+            self._rec_frame, self.format.frames_per_block
+        )
+        inblock = memoryview(inblock)
+        i = 0
+        for frame, count in segments:
+            if self._layer_done:
+                # Each time around the loop is a new pass, so layered
+                # decks get a new track and undo takes one cycle back.
+                self._end_pass()
+                self._begin_pass()
+            length = count * self.format.frame_size
+            self._record(frame, inblock[i : i + length])
+            i += length
+            if self.loop and frame + count == self.loop[1]:
+                self._layer_done = True
+        self._rec_frame = next_frame
+
+    def _audio_callback(self, inblock):
+        start = time.perf_counter()
+        self._commands.drain()
+        self.profiler.drain_time = time.perf_counter() - start
+
+        if self._restoring:
+            self._step_restore()
+
+        if self.scrub_speed:
+            if self.mode == 'recording':
+                self.mode = 'playing'
+            outblock = self._scrub()
+            if self.solo:
+                outblock = self.format.silence
+            next_frame = None
+        else:
+            self._scrub_frame = None
+            outblock, next_frame = self._play()
 
         # We need to record after playing back in case the block is
         # recorded at the same position as playback.
         if self.mode == 'recording':
-            recpos = self.pos - self._stream.play_ahead
-            record_block(self.blocks, recpos, inblock)
+            if self.history.current is None:
+                self._begin_pass()
+            self._record_segments(inblock)
+        elif self.history.current is not None:
+            self._end_pass()
 
-        if self.mode != 'stopped':
-            self.pos += 1
+        # The recording starts from the frame that was played, so the
+        # play head moves on last.
+        if next_frame is not None and self.mode != 'stopped':
+            self._move_to(next_frame)
 
         if self.solo:
-            self._update_meter(inblock)
+            self.meter.update(inblock)
+        else:
+            self.meter.update(inblock, outblock)
+
+        self.notifier.publish(
+            self.mode,
+            self.pos,
+            len(self.tape),
+            self.meter.peak,
+            self.solo,
+            len(self.pass_regions),
+            self.profiler.xruns,
+            self.loop,
+        )
+
+        return outblock
+
+    def _play(self):
+        """Return the block to play and the frame after it."""
+        segments, next_frame = self._split_at_loop(
+            self._get_frame(), self.format.frames_per_block
+        )
+
+        if self.mode != 'stopped' and not self.solo:
+            if self.offset == 0 and len(segments) == 1:
+                outblock = play_block(self.tape, self.pos)
+            else:
+                outblock = self._read_segments(segments)
         else:
-            self._update_meter(audio.sum_blocks([inblock, outblock]))
+            outblock = self.format.silence
+
+        return outblock, next_frame
+
+    def _move_to(self, next_frame):
+        frames_per_block = self.format.frames_per_block
+        if next_frame != self._get_frame() + frames_per_block:
+            self._wrapped = True
+        self.pos, self.offset = divmod(next_frame, frames_per_block)
+
+    def _scrub(self):
+        """Return the block to play at the scrub speed and move on."""
+        frames_per_block = self.format.frames_per_block
+        if self._scrub_frame is None:
+            self._scrub_frame = float(self._get_frame())
+
+        rate = self.scrub_speed
+        if self.mode != 'stopped':
+            rate += 1
+        rate = max(-max_rate, min(rate, max_rate))
+        if rate == 0:
+            return self.format.silence
+
+        frame = self._scrub_frame
+        outblock = self.varispeed.read(self.tape.read, frame, rate)
 
+        frame = self._scrub_frame = max(0.0, frame + rate * frames_per_block)
+        self.pos, self.offset = divmod(int(frame), frames_per_block)
         return outblock
@@ -0,0 +1,52 @@
+"""Changed blocks reported by the audio callback."""
+import collections
+
+
+class DirtyRanges:
+    """(start, end) ranges of changed blocks.
+
+    add() is called from the audio callback and pop() from the thread
+    that catches up. Appending to and popping from a deque from two
+    threads is safe without a lock.
+
+    If nothing pops the ranges (for example the overview when no UI
+    draws it) at most max_ranges are kept. After that everything is
+    taken as changed.
+    """
+
+    def __init__(self, max_ranges=4096):
+        self.max_ranges = max_ranges
+        self._ranges = collections.deque()
+        self._overflow = False
+
+    def add(self, start, end=None):
+        if len(self._ranges) < self.max_ranges:
+            self._ranges.append((start, start + 1 if end is None else end))
+        else:
+            self._overflow = True
+
+    def clear(self):
+        self._overflow = False
+        self._ranges.clear()
+
+    def pop_ranges(self, length):
+        """Take all the ranges and return them cut off at length."""
+        if self._overflow:
+            # Ranges added while clearing are covered by this.
+            self.clear()
+            return [(0, length)] if length > 0 else []
+
+        ranges = []
+        while self._ranges:
+            start, end = self._ranges.popleft()
+            end = min(end, length)
+            if start < end:
+                ranges.append((start, end))
+        return ranges
+
+    def pop(self, length):
+        """Take all the ranges and return the positions below length."""
+        positions = set()
+        for start, end in self.pop_ranges(length):
+            positions.update(range(start, end))
+        return positions
@@ -2,6 +2,12 @@ import os
 import struct
 from dataclasses import dataclass
 
+# struct js_event from linux/joystick.h.
+event_struct = struct.Struct('IhBB')
+JS_EVENT_BUTTON = 0x01
+JS_EVENT_AXIS = 0x02
+JS_EVENT_INIT = 0x80
+
 
 class GamepadEvent:
     def is_axis(self, axis=None):
@@ -49,7 +55,7 @@ def normalize_value(value):
 
 
 def parse_event(data):
-    timestamp, raw_value, event_type, number = struct.unpack('IhBB', data)
+    timestamp, raw_value, event_type, number = event_struct.unpack(data)
     is_init = bool(event_type & 0x80)
 
     type_str = {
@@ -77,8 +83,7 @@ def parse_event(data):
 
 
 def read_event(device):
-    event_size = 8
-    return parse_event(device.read(event_size))
+    return parse_event(device.read(event_struct.size))
 
 
 def gamepad_exists(number):
@@ -101,3 +106,33 @@ def iter_gamepad(number, include_init=False):
                     yield event
             else:
                 yield event
+
+
+class GamepadReader:
+    """Non-blocking gamepad device for use with inputs.InputLoop.
+
+    read_events() reads all pending events in one system call and
+    returns them as raw (timestamp, value, type, number) tuples.
+    """
+
+    def __init__(self, number, max_events=64):
+        self.number = number
+        self.filename = f'/dev/input/js{number}'
+        self._read_size = event_struct.size * max_events
+        self._fd = os.open(self.filename, os.O_RDONLY | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._fd
+
+    def read_events(self):
+        try:
+            data = os.read(self._fd, self._read_size)
+        except BlockingIOError:
+            return ()
+        if not data:
+            raise OSError(f'{self.filename} was closed')
+        # The driver only returns whole events.
+        return event_struct.iter_unpack(data)
+
+    def close(self):
+        os.close(self._fd)
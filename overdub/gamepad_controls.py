@@ -1,22 +1,157 @@
-from .gamepad import iter_gamepad, gamepad_exists
-from .threads import start_thread
-
-
-def start(deck):
-    def handle_gamepad():
-        for event in iter_gamepad(0):
-            if event.is_button_press(0):
-                deck.record()
-            elif event.is_button_press(1):
-                deck.stop()
-            elif event.is_button_press(2):
-                deck.play()
-            elif event.is_button_press(3):
-                deck.goto(0)
-            elif event.is_axis(3):
-                deck.scrub(event.value * -100)
-
-    if gamepad_exists(0):
-        return start_thread(handle_gamepad)
-    else:
-        return None
+"""Gamepad controls.
+
+Gamepads are picked up when they are plugged in and dropped when they
+are unplugged. Buttons and axes are mapped to deck commands by a table
+that can be overridden in ~/.config/overdub/gamepad.json, for example::
+
+    {
+        "buttons": {"0": ["record"], "3": ["goto", 0]},
+        "axes": {"3": ["scrub", -100]}
+    }
+
+Button commands are called with the given arguments when the button is
+pressed. Axis commands are called with the axis value (-1..1) times
+the given scale. Axis updates are sent at most once per audio block.
+"""
+import os
+import json
+from . import config
+from .control import commands
+from .gamepad import (
+    GamepadReader,
+    list_gamepads,
+    JS_EVENT_BUTTON,
+    JS_EVENT_AXIS,
+    JS_EVENT_INIT,
+)
+
+default_mapping = {
+    'buttons': {
+        0: ['record'],
+        1: ['stop'],
+        2: ['play'],
+        3: ['goto', 0],
+    },
+    'axes': {
+        3: ['scrub', -100],
+    },
+}
+
+
+def _check_command(command):
+    if command[0] not in commands:
+        raise ValueError(f'unknown gamepad command {command[0]!r}')
+    return command
+
+
+def load_mapping(filename=None):
+    """Return the button and axis mapping.
+
+    Reads ~/.config/overdub/gamepad.json if it exists. Anything that's
+    not in the file is taken from the default mapping.
+    """
+    if filename is None:
+        filename = config.config_filename('gamepad.json')
+
+    mapping = {
+        'buttons': dict(default_mapping['buttons']),
+        'axes': dict(default_mapping['axes']),
+    }
+
+    if os.path.exists(filename):
+        with open(filename) as infile:
+            user_mapping = json.load(infile)
+
+        for kind in ['buttons', 'axes']:
+            for number, command in user_mapping.get(kind, {}).items():
+                mapping[kind][int(number)] = _check_command(command)
+
+    return mapping
+
+
+class Gamepads:
+    def __init__(self, inputs, deck, mapping=None, scan_interval=1):
+        self.inputs = inputs
+        self.deck = deck
+        self.mapping = mapping or load_mapping()
+        self.readers = {}
+
+        # Latest axis values by command name, waiting to be sent.
+        self._pending = {}
+        self._block_time = deck.format.seconds_per_block
+        self._last_sent = 0
+        self._flush_scheduled = False
+
+        self.scan()
+        inputs.call_every(scan_interval, self.scan)
+
+    def scan(self):
+        """Attach gamepads that have been plugged in."""
+        for number in list_gamepads():
+            if number not in self.readers:
+                self._attach(number)
+
+    def _attach(self, number):
+        try:
+            reader = GamepadReader(number)
+        except OSError:
+            # Not readable (yet). Try again on the next scan.
+            return
+
+        self.readers[number] = reader
+        self.inputs.add_reader(reader, lambda: self._on_readable(reader))
+
+    def _detach(self, reader):
+        self.inputs.remove_reader(reader)
+        reader.close()
+        del self.readers[reader.number]
+
+    def _on_readable(self, reader):
+        try:
+            events = reader.read_events()
+        except OSError:
+            # Unplugged.
+            self._detach(reader)
+            return
+
+        for _, value, event_type, number in events:
+            if event_type & JS_EVENT_INIT:
+                continue
+
+            if event_type == JS_EVENT_BUTTON:
+                if value:
+                    command = self.mapping['buttons'].get(number)
+                    if command:
+                        name, *args = command
+                        getattr(self.deck, name)(*args)
+            elif event_type == JS_EVENT_AXIS:
+                command = self.mapping['axes'].get(number)
+                if command:
+                    name, scale = command
+                    self._pending[name] = value / 0x7FFF * scale
+
+        if self._pending:
+            self._send_axes()
+
+    def _send_axes(self):
+        # Send at most one update per audio block. Anything that comes
+        # in sooner is sent when the block is up.
+        wait = self._last_sent + self._block_time - self.inputs.time()
+        if wait <= 0:
+            for name, value in self._pending.items():
+                getattr(self.deck, name)(value)
+            self._pending.clear()
+            self._last_sent = self.inputs.time()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.inputs.call_later(wait, self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._pending:
+            self._send_axes()
+
+
+def attach(inputs, deck):
+    """Read gamepads from an inputs.InputLoop."""
+    return Gamepads(inputs, deck)
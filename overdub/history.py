@@ -0,0 +1,151 @@
+"""Undo and redo of recording passes.
+
+A pass only keeps the blocks it changed, so everything else is shared
+with the tape. Undoing a pass swaps its saved blocks with the ones on
+the tape, which turns it into a redo entry (and back again).
+"""
+
+
+class Pass:
+    """Blocks overwritten by one recording pass.
+
+    Holds the old contents of each changed block (None for silence) and
+    the length of the tape before the pass.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.images = {}
+        self.size = 0
+
+    def save(self, tape, pos):
+        """Keep the block at pos before it's changed for the first time.
+
+        Returns the number of bytes added to the pass.
+        """
+        if pos in self.images:
+            return 0
+
+        image = self._copy(tape, pos)
+        self.images[pos] = image
+        size = len(image) if image else 0
+        self.size += size
+        return size
+
+    @staticmethod
+    def _copy(tape, pos):
+        if pos < len(tape):
+            block = tape.read(pos)
+            if block != tape.silence:
+                return bytes(block)
+        return None
+
+    def swap(self, tape, batch_size, on_change=None):
+        """Swap the saved blocks with the blocks on the tape.
+
+        This is a generator that yields after every batch_size blocks so
+        the work can be spread over several audio callbacks.
+        """
+        length = len(tape)
+        images = {}
+        size = 0
+
+        for i, (pos, image) in enumerate(self.images.items(), 1):
+            current = self._copy(tape, pos)
+            images[pos] = current
+            size += len(current) if current else 0
+
+            if pos < self.length:
+                tape.write(pos, image or tape.silence)
+            elif image is not None:
+                tape.write(pos, image)
+
+            if on_change:
+                on_change(pos)
+
+            if i % batch_size == 0:
+                yield
+
+        if self.length < len(tape):
+            tape.truncate(self.length)
+        elif self.length > len(tape):
+            tape.write(self.length - 1, tape.silence)
+
+        self.images = images
+        self.length = length
+        self.size = size
+
+
+class TrackPass:
+    """A recording pass in layered mode. Undo removes the whole track."""
+
+    size = 0
+
+    def __init__(self, track):
+        self.track = track
+
+    def save(self, tape, pos):
+        return 0
+
+    def swap(self, mixdown, batch_size, on_change=None):
+        if self.track in mixdown.tracks:
+            mixdown.remove_track(self.track)
+        else:
+            mixdown.restore_track(self.track)
+        yield from ()
+
+
+class History:
+    """Undo and redo stacks with a memory limit.
+
+    When the saved blocks take up more than max_bytes, the oldest passes
+    are forgotten.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.current = None
+        self._undo = []
+        self._redo = []
+
+    def begin(self, entry):
+        self.current = entry
+        self._undo.append(entry)
+        self._forget(self._redo)
+        self._redo = []
+
+    def end(self):
+        self.current = None
+
+    def save(self, tape, pos):
+        """Save the block at pos before the current pass changes it."""
+        self.size += self.current.save(tape, pos)
+
+        # Forget old passes, but never the current one.
+        while self.size > self.max_bytes and len(self._undo) > 1:
+            self._forget([self._undo.pop(0)])
+
+    def _forget(self, entries):
+        for entry in entries:
+            self.size -= entry.size
+
+    def pop_undo(self):
+        """Return the pass to undo, or None."""
+        if self._undo:
+            entry = self._undo.pop()
+            self._redo.append(entry)
+            return entry
+        return None
+
+    def pop_redo(self):
+        """Return the pass to redo, or None."""
+        if self._redo:
+            entry = self._redo.pop()
+            self._undo.append(entry)
+            return entry
+        return None
+
+    def recount(self):
+        """Update the memory count after a pass has been swapped."""
+        self.size = sum(entry.size for entry in self._undo + self._redo)
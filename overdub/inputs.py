@@ -0,0 +1,109 @@
+"""Input event loop.
+
+All input devices (terminal, gamepads, MIDI pedal) are read from one
+thread with a selector instead of one blocking thread per device.
+Device handlers are called when their file is readable and should read
+everything that is available.
+"""
+import os
+import time
+import selectors
+import threading
+from .threads import start_thread
+
+
+class InputLoop:
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._running = False
+        self._thread = None
+
+        # Written to by stop() to wake up select().
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self.add_reader(self._wake_read, self._drain_wakeups)
+
+    def __len__(self):
+        """Return the number of readers (not counting the wakeup pipe)."""
+        return len(self._selector.get_map()) - 1
+
+    def has_work(self):
+        """Return True if there are readers or timers to run.
+
+        Timers count since they can add readers later, for example for
+        gamepads that are plugged in after the start.
+        """
+        return len(self) > 0 or bool(self._timers)
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() whenever fileobj is readable."""
+        self._selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def time(self):
+        """Return the clock used for timers."""
+        return time.monotonic()
+
+    def call_every(self, interval, callback):
+        """Call callback() every interval seconds."""
+        self._timers.append([time.monotonic() + interval, interval, callback])
+
+    def call_later(self, delay, callback):
+        """Call callback() once after delay seconds."""
+        self._timers.append([time.monotonic() + delay, None, callback])
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _get_timeout(self):
+        if self._timers:
+            next_time = min(timer[0] for timer in self._timers)
+            return max(0, next_time - time.monotonic())
+        return None
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = [timer for timer in self._timers if timer[0] <= now]
+
+        for timer in due:
+            next_time, interval, callback = timer
+            if interval is None:
+                self._timers.remove(timer)
+            else:
+                # Skip missed calls instead of running them all.
+                timer[0] = max(next_time + interval, now)
+            callback()
+
+    def run(self):
+        """Handle events until stop() is called."""
+        self._running = True
+        while self._running:
+            for key, _ in self._selector.select(self._get_timeout()):
+                key.data()
+                if not self._running:
+                    break
+            self._run_timers()
+
+    def start(self):
+        """Run the loop in a background thread."""
+        self._thread = start_thread(self.run)
+
+    def stop(self):
+        """Stop the loop. Can be called from any thread."""
+        self._running = False
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+            self._thread = None
@@ -0,0 +1,145 @@
+"""Autosave journal.
+
+The audio callback reports which blocks it has changed. A background
+thread appends the contents of those blocks to a journal file next to
+the WAV or session file. After a crash the journal is replayed onto the
+tape.
+
+On save only the blocks changed since the last checkpoint are written
+to the file, and the journal is emptied.
+"""
+import os
+import struct
+import threading
+import collections
+from . import audio
+from .threads import start_thread
+
+record_header = struct.Struct('<QI')
+
+
+def journal_filename(filename):
+    return filename + '.journal'
+
+
+def replay(filename, tape, on_change=None):
+    """Apply journal records to the tape.
+
+    Returns the set of positions that were changed. on_change(pos) is
+    called for each record. A truncated record at the end (from a crash
+    in the middle of a write) is ignored.
+    """
+    positions = set()
+
+    with open(filename, 'rb') as infile:
+        while header := infile.read(record_header.size):
+            if len(header) < record_header.size:
+                break
+
+            pos, size = record_header.unpack(header)
+            block = infile.read(size)
+            if len(block) < size:
+                break
+
+            tape.write(pos, block)
+            positions.add(pos)
+            if on_change:
+                on_change(pos)
+
+    return positions
+
+
+class Journal:
+    def __init__(
+        self,
+        tape,
+        filename,
+        fmt=audio.default_format,
+        interval=1,
+        max_blocks_per_write=256,
+        save_changed=audio.save_changed,
+        on_change=None,
+    ):
+        """save_changed(filename, tape, positions, fmt) writes changed
+        blocks to the file. on_change(pos) is called for each block
+        recovered from an old journal.
+        """
+        self.tape = tape
+        self.format = fmt
+        self.filename = filename
+        self.interval = interval
+        self.max_blocks_per_write = max_blocks_per_write
+        self._save_changed = save_changed
+
+        # Positions reported by the audio callback. Appending to a
+        # deque is thread safe and doesn't take a lock.
+        self._pending = collections.deque()
+        # Changed blocks not yet in the journal.
+        self._unwritten = set()
+        # Changed blocks not yet in the file.
+        self._changed = set()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self.journal_filename = journal_filename(filename)
+        if os.path.exists(self.journal_filename):
+            self._changed = replay(self.journal_filename, tape, on_change)
+        self._file = open(self.journal_filename, 'ab')
+
+        self._thread = start_thread(self._run)
+
+    def mark_dirty(self, pos):
+        """Report a changed block. Called from the audio callback."""
+        self._pending.append(pos)
+
+    def _collect(self):
+        while self._pending:
+            pos = self._pending.popleft()
+            self._unwritten.add(pos)
+            self._changed.add(pos)
+
+    def _write_some(self):
+        with self._lock:
+            self._collect()
+            positions = sorted(self._unwritten)[: self.max_blocks_per_write]
+
+            for pos in positions:
+                block = self.tape.read(pos)
+                self._file.write(record_header.pack(pos, len(block)))
+                self._file.write(block)
+                self._unwritten.discard(pos)
+
+            if positions:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write_some()
+
+    def save(self):
+        """Write changed blocks to the file and empty the journal."""
+        with self._lock:
+            self._collect()
+            self._save_changed(
+                self.filename, self.tape, self._changed, self.format
+            )
+            self._changed.clear()
+            self._unwritten.clear()
+            self._file.truncate(0)
+            self._file.flush()
+
+    def close(self):
+        """Stop the writer thread.
+
+        The journal file is removed if everything has been saved.
+        """
+        self._stop.set()
+        self._thread.join()
+
+        with self._lock:
+            self._collect()
+            self._file.close()
+            if not self._changed:
+                os.remove(self.journal_filename)
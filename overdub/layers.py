@@ -0,0 +1,194 @@
+import threading
+from .tape import Tape
+from .threads import start_thread
+from . import mixing
+
+# States of a block in the mixdown cache.
+DIRTY = 0
+MIXING = 1
+CLEAN = 2
+
+
+class Track:
+    def __init__(self, tape, gain=1.0, mute=False):
+        self.tape = tape
+        self.gain = gain
+        self.mute = mute
+
+
+class Mixdown:
+    """A stack of tracks that plays back like a single tape.
+
+    The mix is cached per block. A background thread mixes dirty blocks
+    ahead of the play head, so the audio callback normally just reads
+    from the cache. If it finds a dirty block it mixes it on the spot
+    (without touching the cache) and counts a miss.
+
+    Only the background thread (or a save) writes to the cache. The
+    audio callback only ever marks blocks dirty.
+    """
+
+    def __init__(self, bytes_per_block, make_tape=Tape):
+        """make_tape(bytes_per_block) is used to create new tracks."""
+        self.bytes_per_block = bytes_per_block
+        self.make_tape = make_tape
+        self.silence = bytes(bytes_per_block)
+        self.tracks = []
+        self.misses = 0
+
+        self._cache = Tape(bytes_per_block)
+        self._cache_lock = threading.Lock()
+        # One state byte per block.
+        self._states = bytearray()
+
+        self._acc = mixing.Accumulator(bytes_per_block)
+        self._scratch = bytearray(bytes_per_block)
+        self._worker_acc = mixing.Accumulator(bytes_per_block)
+        self._worker_scratch = bytearray(bytes_per_block)
+
+        self._stop = None
+        self._thread = None
+
+    def __len__(self):
+        return max((len(track.tape) for track in self.tracks), default=0)
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self.read(pos)
+
+    def add_track(self, tape=None):
+        """Add a new track on top of the stack and return it."""
+        if tape is None:
+            tape = self.make_tape(self.bytes_per_block)
+        track = Track(tape)
+        self.restore_track(track)
+        return track
+
+    # The track list is replaced instead of modified, so the prefetch
+    # thread can safely iterate over it.
+
+    def remove_track(self, track):
+        self.tracks = [t for t in self.tracks if t is not track]
+        self.invalidate_range(0, len(track.tape))
+
+    def restore_track(self, track):
+        self.tracks = self.tracks + [track]
+        self.invalidate_range(0, len(track.tape))
+
+    def invalidate(self, pos):
+        if 0 <= pos < len(self._states):
+            self._states[pos] = DIRTY
+
+    def invalidate_range(self, start, end):
+        end = min(end, len(self._states))
+        if start < end:
+            self._states[start:end] = bytes(end - start)
+
+    def invalidate_all(self):
+        self.invalidate_range(0, len(self._states))
+
+    def set_gain(self, index, gain):
+        track = self.tracks[index]
+        track.gain = gain
+        self.invalidate_range(0, len(track.tape))
+
+    def set_mute(self, index, mute):
+        track = self.tracks[index]
+        track.mute = mute
+        self.invalidate_range(0, len(track.tape))
+
+    def _mix(self, pos, acc, dest):
+        acc.clear()
+        for track in self.tracks:
+            if not track.mute and pos < len(track.tape):
+                block = track.tape.read(pos)
+                if block is not track.tape.silence:
+                    acc.add(block, track.gain)
+        acc.store(dest)
+
+    def _update(self, pos):
+        # Must be called with the cache lock held.
+        if pos >= len(self._states):
+            grow = max(pos + 1 - len(self._states), len(self._states))
+            self._states.extend(bytes(grow))
+
+        # If the block is invalidated while we mix it, it stays dirty.
+        self._states[pos] = MIXING
+        self._mix(pos, self._worker_acc, self._worker_scratch)
+        self._cache.write(pos, self._worker_scratch)
+        if self._states[pos] == MIXING:
+            self._states[pos] = CLEAN
+
+    def update_range(self, start, end):
+        """Mix all dirty blocks in range."""
+        end = min(end, len(self))
+        with self._cache_lock:
+            for pos in range(max(start, 0), end):
+                if pos >= len(self._states) or self._states[pos] != CLEAN:
+                    self._update(pos)
+
+    def read(self, pos):
+        if not 0 <= pos < len(self):
+            return self.silence
+
+        if pos < len(self._states) and self._states[pos] == CLEAN:
+            return self._cache.read(pos)
+
+        self.misses += 1
+        self._mix(pos, self._acc, self._scratch)
+        return self._scratch
+
+    def read_mixed(self, pos):
+        """Like read() but safe to call from other threads.
+
+        Mixes the block into the cache if needed and returns a copy.
+        """
+        if not 0 <= pos < len(self):
+            return self.silence
+
+        with self._cache_lock:
+            if pos >= len(self._states) or self._states[pos] != CLEAN:
+                self._update(pos)
+            return bytes(self._cache.read(pos))
+
+    def iter_chunks(self):
+        length = len(self)
+        self.update_range(0, length)
+        with self._cache_lock:
+            # Undoing a track can leave the cache longer than the mix.
+            if len(self._cache) > length:
+                self._cache.truncate(length)
+                del self._states[length:]
+            chunks = self._cache.iter_chunks()
+
+        # The lock is only held while a chunk is copied, so the prefetch
+        # thread can go on while the caller writes it out.
+        while True:
+            with self._cache_lock:
+                data = next(chunks, None)
+                if data is None:
+                    return
+                data = bytes(data)
+            yield data
+
+    def start_prefetch(self, get_positions, lookahead, interval):
+        """Start a thread that mixes blocks ahead of the play head.
+
+        get_positions() returns the positions that playback will read
+        from next, such as the play head and the loop start. lookahead
+        is in blocks and interval in seconds.
+        """
+        stop = self._stop = threading.Event()
+
+        def prefetch():
+            while not stop.wait(interval):
+                for pos in get_positions():
+                    self.update_range(pos, pos + lookahead)
+
+        self._thread = start_thread(prefetch)
+
+    def stop_prefetch(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
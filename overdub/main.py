@@ -1,37 +1,190 @@
+import os
+import sys
 import argparse
+import functools
+import dataclasses
+from . import audio
+from . import session
 from .deck import Deck
+from .inputs import InputLoop
 
 
 def parse_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog='Run "overdub bounce --help" to bounce files in bulk.'
+    )
     arg = parser.add_argument
 
     arg('--terminal', '-t', action='store_true', help='run in terminal')
     arg('--minimalist', '-m', action='store_true', help='use minimalst UI')
     arg('--gamepad', '-g', action='store_true', help='use gamepad controls')
     arg('--punch-pedal', '-p', action='store_true', help='punch in/out pedal')
-    arg('filename', metavar='file.wav', help='WAV file to overdub onto')
+    arg('--mmap', action='store_true', help='edit WAV file in place')
+    arg('--layers', action='store_true', help='record each pass as a layer')
+    arg('--sparse', action='store_true', help="don't store silent blocks")
+    arg(
+        '--dedup',
+        action='store_true',
+        help='like --sparse and also share identical blocks',
+    )
+    arg(
+        '--undo-memory',
+        type=int,
+        default=256,
+        metavar='MB',
+        help='memory to use for undo history (default 256)',
+    )
+    arg('--rate', type=int, help='sample rate (default: from file or 44100)')
+    arg('--channels', type=int, help='channels (default: from file or 2)')
+    arg('--block-size', type=int, metavar='FRAMES', help='frames per block')
+    arg(
+        '--low-latency',
+        action='store_true',
+        help='use small blocks (256 frames) and low device latency',
+    )
+    arg('--stats', action='store_true', help='show callback timing and xruns')
+    arg('--trace', metavar='FILE', help='write per-callback trace to CSV file')
+    arg(
+        '--calibrate',
+        action='store_true',
+        help='measure round trip latency (loop output back to input)',
+    )
+    arg(
+        '--control',
+        action='store_true',
+        help='accept commands on a Unix socket (see overdub/control.py)',
+    )
+    arg('--socket', metavar='PATH', help='socket path for --control')
+    arg(
+        '--render',
+        metavar='TAKE',
+        help='record TAKE onto the file without audio hardware and exit',
+    )
+    arg(
+        '--at',
+        type=float,
+        default=0,
+        metavar='SECONDS',
+        help='where to start recording with --render (default 0)',
+    )
+    arg(
+        'filename',
+        metavar='file.wav',
+        nargs='?',
+        help='WAV file or compressed session file (.ovd) to overdub onto',
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.filename is None and not args.calibrate:
+        parser.error('the following arguments are required: file.wav')
+    if args.mmap and args.layers:
+        parser.error('--mmap and --layers can not be used together')
+
+    return args
+
+
+def get_format(args):
+    """Return audio format from arguments and the file."""
+    if args.block_size:
+        frames_per_block = args.block_size
+    elif args.low_latency:
+        frames_per_block = 256
+    else:
+        frames_per_block = audio.frames_per_block
+
+    if args.filename and os.path.exists(args.filename):
+        if session.is_session_file(args.filename):
+            read_format = session.read_format
+        else:
+            read_format = audio.read_format
+        fmt = read_format(args.filename, frames_per_block)
+    else:
+        fmt = audio.Format(frames_per_block=frames_per_block)
+
+    if args.rate:
+        fmt = dataclasses.replace(fmt, frame_rate=args.rate)
+    if args.channels:
+        fmt = dataclasses.replace(fmt, channels=args.channels)
+
+    return fmt
 
 
 def main():
+    if sys.argv[1:2] == ['bounce']:
+        from .bounce import main
+
+        return main(sys.argv[2:])
+
     args = parse_args()
-    deck = Deck()
+    fmt = get_format(args)
+    latency = 'low' if args.low_latency else 'high'
+
+    if args.calibrate:
+        from .calibration import calibrate
+
+        device_key, frames = calibrate(fmt, latency)
+        print(f'{device_key}: {frames} frames')
+        return
+
+    if args.render:
+        from .offline import OfflineStream, render
+
+        backend = functools.partial(OfflineStream, source=args.render)
+    else:
+        backend = audio.Stream
+
+    deck = Deck(
+        fmt=fmt,
+        latency=latency,
+        mapped=args.mmap,
+        layered=args.layers,
+        sparse=args.sparse,
+        dedup=args.dedup,
+        undo_memory=args.undo_memory * 2**20,
+        trace_filename=args.trace,
+        backend=backend,
+    )
+
+    if args.render:
+        render(deck, args.filename, start=args.at)
+        return
+
+    # All input devices are read by one thread.
+    inputs = InputLoop()
 
     if args.gamepad:
         from overdub import gamepad_controls
 
-        gamepad_controls.start(deck)
+        gamepad_controls.attach(inputs, deck)
 
     if args.punch_pedal:
         from overdub import punch_pedal
 
-        punch_pedal.start(deck)
+        if not punch_pedal.attach(inputs, deck):
+            # No raw MIDI device. Fall back to meep.
+            punch_pedal.start(deck)
 
     if args.terminal:
         from .terminal_ui import ui
     else:
         from .tkinter_ui import ui
 
-    ui(deck, args.filename, minimalist=args.minimalist)
+    if args.control:
+        from .control import ControlServer
+
+        server = ControlServer(deck, args.socket)
+        server.start()
+    else:
+        server = None
+
+    try:
+        ui(
+            deck,
+            args.filename,
+            minimalist=args.minimalist,
+            stats=args.stats,
+            inputs=inputs,
+        )
+    finally:
+        if server:
+            server.stop()
@@ -0,0 +1,46 @@
+"""Peak and RMS level meter."""
+from . import mixing
+
+
+class Meter:
+    """Levels per channel, normalized to 0..1.
+
+    Peaks fall at fall_per_second so short peaks stay visible. RMS is
+    the level of the last update.
+    """
+
+    def __init__(self, fmt, fall_per_second=2):
+        self.channels = fmt.channels
+        self.fall = fall_per_second * fmt.seconds_per_block
+        self.silence = fmt.silence
+        self.peaks = [0.0] * fmt.channels
+        self.rms = [0.0] * fmt.channels
+
+    @property
+    def peak(self):
+        return max(self.peaks)
+
+    def update(self, *blocks):
+        """Update levels from one block of input and/or output.
+
+        With more than one block each channel shows the loudest of
+        them. Silent blocks are skipped.
+        """
+        peaks = [peak - self.fall for peak in self.peaks]
+        rms = [0.0] * self.channels
+
+        for block in blocks:
+            if block is self.silence:
+                continue
+
+            block_peaks, block_rms = mixing.get_levels(block, self.channels)
+            for channel in range(self.channels):
+                peaks[channel] = max(
+                    peaks[channel], block_peaks[channel] / mixing.max_sample
+                )
+                rms[channel] = max(
+                    rms[channel], block_rms[channel] / mixing.max_sample
+                )
+
+        self.peaks = [max(peak, 0.0) for peak in peaks]
+        self.rms = rms
@@ -0,0 +1,93 @@
+"""Raw ALSA MIDI input.
+
+Reads bytes from /dev/snd/midiC*D* devices. Only channel messages are
+passed on. System messages are skipped.
+"""
+import os
+import re
+import glob
+
+
+def list_devices():
+    """Return a list of (filename, card id) for raw MIDI devices."""
+    devices = []
+    for filename in sorted(glob.glob('/dev/snd/midiC*D*')):
+        card = re.search(r'midiC(\d+)D', filename).group(1)
+        try:
+            with open(f'/proc/asound/card{card}/id') as infile:
+                card_id = infile.read().strip()
+        except OSError:
+            card_id = ''
+        devices.append((filename, card_id))
+    return devices
+
+
+def find_device(name):
+    """Return filename of first raw MIDI device with name in its card id."""
+    for filename, card_id in list_devices():
+        if name.lower() in card_id.lower():
+            return filename
+    return None
+
+
+# Number of data bytes for channel messages by status high nibble.
+_data_sizes = {
+    0x80: 2,
+    0x90: 2,
+    0xA0: 2,
+    0xB0: 2,
+    0xC0: 1,
+    0xD0: 1,
+    0xE0: 2,
+}
+
+
+class MidiParser:
+    """Turns a byte stream into (status, data...) tuples.
+
+    Handles running status and messages split across reads.
+    """
+
+    def __init__(self):
+        self._status = None
+        self._data = []
+
+    def feed(self, data):
+        for byte in data:
+            if byte >= 0xF8:
+                # Real time messages can appear anywhere.
+                continue
+            elif byte >= 0xF0:
+                # System common and sysex. Ignore until next status.
+                self._status = None
+                self._data = []
+            elif byte >= 0x80:
+                self._status = byte
+                self._data = []
+            elif self._status is not None:
+                self._data.append(byte)
+                if len(self._data) == _data_sizes[self._status & 0xF0]:
+                    yield (self._status, *self._data)
+                    self._data = []
+
+
+class MidiReader:
+    """Non-blocking raw MIDI device for use with inputs.InputLoop."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+        self._parser = MidiParser()
+
+    def fileno(self):
+        return self._fd
+
+    def read_messages(self):
+        try:
+            data = os.read(self._fd, 1024)
+        except BlockingIOError:
+            return []
+        return list(self._parser.feed(data))
+
+    def close(self):
+        os.close(self._fd)
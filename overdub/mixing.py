@@ -0,0 +1,384 @@
+"""Saturating arithmetic on blocks of 16 bit samples.
+
+There are three backends. NumPy is used if it's installed. Otherwise
+audioop is used (it's in the standard library up to Python 3.12). The
+pure Python backend is the last resort. It takes about a millisecond
+per block, which is too slow for layered mode, so on Python 3.13 and
+later NumPy is required.
+
+All backends clamp after each addition so the result is the same as
+adding the blocks one by one.
+"""
+import math
+import array
+import collections
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# audioop warns that it's deprecated on import. NumPy replaces it where
+# it's gone.
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:
+        audioop = None
+
+
+sample_size = 2
+min_sample = -32768
+max_sample = 32767
+
+
+def _python_add_blocks(blocka, blockb):
+    # Only works on little endian machines where 'h' is 16 bit.
+    a = array.array('h')
+    a.frombytes(blocka)
+
+    b = array.array('h')
+    b.frombytes(blockb)
+
+    for i in range(len(a)):
+        sum = a[i] + b[i]
+        if sum < min_sample:
+            sum = min_sample
+        elif sum > max_sample:
+            sum = max_sample
+        a[i] = sum
+
+    return a.tobytes()
+
+
+def _python_mix_into(dest, src):
+    d = memoryview(dest).cast('h')
+    s = memoryview(src).cast('B').cast('h')
+
+    for i in range(len(d)):
+        sum = d[i] + s[i]
+        if sum < min_sample:
+            sum = min_sample
+        elif sum > max_sample:
+            sum = max_sample
+        d[i] = sum
+
+
+def _python_scale_block(block, gain):
+    arr = array.array('h')
+    arr.frombytes(block)
+
+    for i in range(len(arr)):
+        value = int(arr[i] * gain)
+        arr[i] = min(max(value, min_sample), max_sample)
+
+    return arr.tobytes()
+
+
+def _python_get_max_value(block):
+    arr = array.array('h')
+    arr.frombytes(block)
+
+    return max(max(arr), abs(min(arr)))
+
+
+def _python_get_levels(block, channels):
+    arr = array.array('h')
+    arr.frombytes(block)
+
+    peaks = []
+    rms = []
+    for channel in range(channels):
+        samples = arr[channel::channels]
+        peaks.append(max(max(samples), -min(samples)))
+        rms.append(math.sqrt(sum(x * x for x in samples) / len(samples)))
+
+    return peaks, rms
+
+
+def _get_block_peaks(get_max_value):
+    def get_block_peaks(data, bytes_per_block):
+        data = memoryview(data).cast('B')
+        return [
+            get_max_value(data[i : i + bytes_per_block])
+            for i in range(0, len(data), bytes_per_block)
+        ]
+
+    return get_block_peaks
+
+
+def _audioop_add_blocks(blocka, blockb):
+    return audioop.add(blocka, blockb, sample_size)
+
+
+def _audioop_mix_into(dest, src):
+    dest[:] = audioop.add(dest, src, sample_size)
+
+
+def _audioop_scale_block(block, gain):
+    return audioop.mul(block, sample_size, gain)
+
+
+def _audioop_get_max_value(block):
+    return audioop.max(block, sample_size)
+
+
+def _audioop_get_levels(block, channels):
+    if channels == 1:
+        return [audioop.max(block, sample_size)], [
+            audioop.rms(block, sample_size)
+        ]
+    elif channels == 2:
+        left = audioop.tomono(block, sample_size, 1, 0)
+        right = audioop.tomono(block, sample_size, 0, 1)
+        return (
+            [audioop.max(left, sample_size), audioop.max(right, sample_size)],
+            [audioop.rms(left, sample_size), audioop.rms(right, sample_size)],
+        )
+    else:
+        return _python_get_levels(block, channels)
+
+
+def _numpy_add_blocks(blocka, blockb):
+    return _numpy_sum_blocks([blocka, blockb])
+
+
+def _numpy_sum_blocks(blocks):
+    it = iter(blocks)
+    acc = numpy.frombuffer(next(it), numpy.int16).astype(numpy.int32)
+    for block in it:
+        acc += numpy.frombuffer(block, numpy.int16)
+        numpy.clip(acc, min_sample, max_sample, out=acc)
+    return acc.astype(numpy.int16).tobytes()
+
+
+_numpy_scratch = {}
+
+
+def _numpy_mix_into(dest, src):
+    d = numpy.frombuffer(dest, numpy.int16)
+    s = numpy.frombuffer(src, numpy.int16)
+
+    # Reuse the 32 bit scratch array so we don't allocate per block.
+    scratch = _numpy_scratch.get(len(d))
+    if scratch is None:
+        scratch = _numpy_scratch[len(d)] = numpy.empty(len(d), numpy.int32)
+
+    numpy.add(d, s, out=scratch, dtype=numpy.int32)
+    numpy.clip(scratch, min_sample, max_sample, out=scratch)
+    numpy.copyto(d, scratch, casting='unsafe')
+
+
+def _numpy_scale_block(block, gain):
+    arr = numpy.frombuffer(block, numpy.int16) * gain
+    numpy.clip(arr, min_sample, max_sample, out=arr)
+    return arr.astype(numpy.int16).tobytes()
+
+
+class _NumpyAccumulator:
+    def __init__(self, size):
+        self._acc = numpy.zeros(size // sample_size, numpy.float32)
+        self._tmp = numpy.empty(size // sample_size, numpy.float32)
+
+    def clear(self):
+        self._acc.fill(0)
+
+    def add(self, block, gain=1.0):
+        samples = numpy.frombuffer(block, numpy.int16)
+        if gain == 1:
+            numpy.add(self._acc, samples, out=self._acc)
+        else:
+            numpy.multiply(samples, gain, out=self._tmp)
+            numpy.clip(self._tmp, min_sample, max_sample, out=self._tmp)
+            numpy.add(self._acc, self._tmp, out=self._acc)
+        # Clamped after each block like the other backends.
+        numpy.clip(self._acc, min_sample, max_sample, out=self._acc)
+
+    def store(self, dest):
+        samples = numpy.frombuffer(dest, numpy.int16)
+        numpy.copyto(samples, self._acc, casting='unsafe')
+
+
+def _numpy_get_max_value(block):
+    arr = numpy.frombuffer(block, numpy.int16)
+    return max(int(arr.max()), -int(arr.min()))
+
+
+def _numpy_get_levels(block, channels):
+    frames = numpy.frombuffer(block, numpy.int16).reshape(-1, channels)
+    peaks = numpy.maximum(frames.max(0), -frames.min(0).astype(numpy.int32))
+    samples = frames.astype(numpy.float32)
+    rms = numpy.sqrt(numpy.einsum('ij,ij->j', samples, samples) / len(frames))
+    return peaks.tolist(), rms.tolist()
+
+
+def _numpy_get_block_peaks(data, bytes_per_block):
+    blocks = numpy.frombuffer(data, numpy.int16).reshape(
+        -1, bytes_per_block // sample_size
+    )
+    peaks = numpy.maximum(blocks.max(1), -blocks.min(1).astype(numpy.int32))
+    return peaks.tolist()
+
+
+class _BytesAccumulator:
+    # Adds blocks one by one with saturation.
+    def __init__(self, size):
+        self._silence = bytes(size)
+        self._acc = self._silence
+
+    def clear(self):
+        self._acc = self._silence
+
+    def add(self, block, gain=1.0):
+        if gain != 1:
+            block = scale_block(block, gain)
+        self._acc = add_blocks(self._acc, block)
+
+    def store(self, dest):
+        dest[:] = self._acc
+
+
+def _pairwise_sum_blocks(add_blocks):
+    def sum_blocks(blocks):
+        it = iter(blocks)
+        blocksum = next(it)
+        for block in it:
+            blocksum = add_blocks(blocksum, block)
+        return bytes(blocksum)
+
+    return sum_blocks
+
+
+Backend = collections.namedtuple(
+    'Backend',
+    [
+        'add_blocks',
+        'sum_blocks',
+        'mix_into',
+        'get_max_value',
+        'get_levels',
+        'get_block_peaks',
+        'scale_block',
+        'accumulator',
+    ],
+)
+
+backends = {
+    'python': Backend(
+        _python_add_blocks,
+        _pairwise_sum_blocks(_python_add_blocks),
+        _python_mix_into,
+        _python_get_max_value,
+        _python_get_levels,
+        _get_block_peaks(_python_get_max_value),
+        _python_scale_block,
+        _BytesAccumulator,
+    ),
+}
+
+if audioop is not None:
+    backends['audioop'] = Backend(
+        _audioop_add_blocks,
+        _pairwise_sum_blocks(_audioop_add_blocks),
+        _audioop_mix_into,
+        _audioop_get_max_value,
+        _audioop_get_levels,
+        _get_block_peaks(_audioop_get_max_value),
+        _audioop_scale_block,
+        _BytesAccumulator,
+    )
+
+if numpy is not None:
+    backends['numpy'] = Backend(
+        _numpy_add_blocks,
+        _numpy_sum_blocks,
+        _numpy_mix_into,
+        _numpy_get_max_value,
+        _numpy_get_levels,
+        _numpy_get_block_peaks,
+        _numpy_scale_block,
+        _NumpyAccumulator,
+    )
+
+
+def use(name):
+    """Select mixing backend ('numpy', 'audioop' or 'python')."""
+    global backend, _backend
+
+    if name not in backends:
+        raise ValueError(f'mixing backend {name!r} is not available')
+
+    backend = name
+    _backend = backends[name]
+
+
+use(list(backends)[-1])
+
+
+def add_blocks(blocka, blockb):
+    """Return the saturated sum of two blocks."""
+    return _backend.add_blocks(blocka, blockb)
+
+
+def sum_blocks(blocks, silence):
+    """Return the saturated sum of all blocks.
+
+    None values and empty blocks are skipped. Returns silence if there
+    is nothing to add.
+    """
+    blocks = [block for block in blocks if block]
+    if not blocks:
+        return silence
+    elif len(blocks) == 1:
+        return bytes(blocks[0])
+    else:
+        return _backend.sum_blocks(blocks)
+
+
+def mix_into(dest, src):
+    """Add src to dest in place (saturated).
+
+    dest must be a writable buffer such as a memoryview into a bytearray.
+    """
+    _backend.mix_into(dest, src)
+
+
+def get_max_value(block):
+    """Return maximum absolute sample value in block (not normalized)."""
+    return _backend.get_max_value(block)
+
+
+def get_levels(block, channels):
+    """Return (peaks, rms) with one value per channel (not normalized)."""
+    return _backend.get_levels(block, channels)
+
+
+def get_block_peaks(data, bytes_per_block):
+    """Return a list of the maximum absolute sample value of each block.
+
+    data is a buffer of one or more whole blocks.
+    """
+    return _backend.get_block_peaks(data, bytes_per_block)
+
+
+def scale_block(block, gain):
+    """Return block with all samples multiplied by gain (saturated)."""
+    return _backend.scale_block(block, gain)
+
+
+def Accumulator(size):
+    """Return an accumulator for mixing blocks of size bytes.
+
+    Usage::
+
+        acc.clear()
+        acc.add(block, gain)
+        ...
+        acc.store(dest)
+
+    With NumPy the sum is kept in floating point and nothing is
+    allocated per block.
+    """
+    return _backend.accumulator(size)
@@ -0,0 +1,91 @@
+"""Status change notification.
+
+The audio callback publishes a few cheap values at the end of every
+block. Each subscription turns them into a key at its own resolution
+(for example whole seconds and 20 meter steps) and when the key
+changes it writes a byte to a pipe. UIs wait on the pipe with select()
+or a Tk file handler and only redraw when something has changed.
+"""
+import os
+
+
+class Subscription:
+    def __init__(self, blocks_per_second, ticks_per_second=1, meter_steps=20):
+        self.blocks_per_tick = blocks_per_second / ticks_per_second
+        self.meter_steps = meter_steps
+        self._last = None
+
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def _check(self, mode, pos, length, meter, extra):
+        key = (
+            mode,
+            int(pos / self.blocks_per_tick),
+            int(length / self.blocks_per_tick),
+            int(meter * self.meter_steps),
+            extra,
+        )
+        if key != self._last:
+            self._last = key
+            try:
+                os.write(self._write_fd, b'\0')
+            except BlockingIOError:
+                # The pipe is full so a wakeup is already pending.
+                pass
+
+    def clear(self):
+        """Empty the pipe. Call this before reading the status."""
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class StatusNotifier:
+    def __init__(self, fmt):
+        self.blocks_per_second = fmt.blocks_per_second
+        # Replaced instead of modified so the audio callback can
+        # safely iterate over it.
+        self.subscriptions = []
+
+    def subscribe(self, ticks_per_second=1, meter_steps=20):
+        """Return a new subscription.
+
+        The subscription is notified when the mode, the play position or
+        the end of the tape moves to a new tick, or when the meter moves
+        to a new step.
+        """
+        subscription = Subscription(
+            self.blocks_per_second, ticks_per_second, meter_steps
+        )
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop notifying subscription.
+
+        The audio callback may still be using it, so only close it once
+        the stream has been stopped.
+        """
+        self.subscriptions = [
+            s for s in self.subscriptions if s is not subscription
+        ]
+
+    def publish(self, mode, pos, length, meter, *extra):
+        """Notify subscriptions. Called from the audio callback.
+
+        pos and length are in blocks. Any change in extra is always
+        notified.
+        """
+        for subscription in self.subscriptions:
+            subscription._check(mode, pos, length, meter, extra)
@@ -0,0 +1,93 @@
+"""Offline stream backend.
+
+OfflineStream calls the deck's audio callback as fast as possible
+instead of in real time. Input comes from a WAV file or an iterable of
+blocks, and the output can be captured to a tape. This is used to
+render takes onto a tape from the command line and to benchmark the
+audio callback without audio hardware.
+"""
+import os
+import time
+import itertools
+from . import audio
+from .tape import Tape
+
+
+class OfflineStream:
+    def __init__(
+        self,
+        callback,
+        fmt=audio.default_format,
+        latency='high',
+        profiler=None,
+        source=None,
+        numblocks=None,
+        capture=False,
+    ):
+        """source is a WAV filename, an iterable of blocks or None.
+
+        With no source, numblocks silent blocks are fed to the callback.
+        Otherwise the stream stops after numblocks blocks or when the
+        source runs out. If capture is true the output is stored in
+        self.output.
+        """
+        self.callback = callback
+        self.format = fmt
+        self.profiler = profiler
+        self.source = source
+        self.numblocks = numblocks
+        self.output = Tape(fmt.bytes_per_block) if capture else None
+
+        # The input is perfectly lined up with the output.
+        self.latency = 0
+        self.latency_frames = 0
+        self.device_key = (
+            f'offline|{fmt.frame_rate}|{fmt.frames_per_block}|{latency}'
+        )
+
+    def _iter_input(self):
+        if self.source is None:
+            blocks = itertools.repeat(self.format.silence)
+        elif isinstance(self.source, (str, os.PathLike)):
+            blocks = audio.iter_blocks(self.source, self.format)
+        else:
+            blocks = iter(self.source)
+
+        if self.numblocks is not None:
+            blocks = itertools.islice(blocks, self.numblocks)
+
+        return blocks
+
+    def start(self):
+        """Run the callback on all the input. Returns when done."""
+        callback = self.callback
+        profiler = self.profiler
+        output = self.output
+
+        for inblock in self._iter_input():
+            start = time.perf_counter()
+            outblock = callback(bytes(inblock))
+            if profiler is not None:
+                profiler.record(start, time.perf_counter())
+            if output is not None:
+                output.append(outblock)
+
+    def stop(self):
+        pass
+
+
+def render(deck, filename, start=0):
+    """Record the deck's input onto a WAV file starting at start seconds.
+
+    The deck must have been created with an OfflineStream backend.
+    """
+    if os.path.exists(filename):
+        deck.load(filename)
+
+    deck.goto(start)
+    deck.record()
+    deck.start_stream()
+    deck.stop_stream()
+
+    deck.save(filename)
+    deck.close()
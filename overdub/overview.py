@@ -0,0 +1,164 @@
+"""Peak overview of the tape for drawing waveforms.
+
+Level 0 has the peak of every block. Each level above has the peak of
+factor entries of the level below, up to a single entry for the whole
+tape. A display of any width can be drawn from the smallest level that
+has at least one entry per column, without scanning the tape.
+
+The audio callback reports changed blocks and the peaks are brought up
+to date by refresh() in the UI thread.
+"""
+import array
+import threading
+from . import mixing
+from .dirty import DirtyRanges
+from .threads import start_thread
+
+
+class Overview:
+    def __init__(self, bytes_per_block, factor=4):
+        self.bytes_per_block = bytes_per_block
+        self.factor = factor
+        self.levels = [array.array('H')]
+
+        self._dirty = DirtyRanges()
+        self._lock = threading.Lock()
+        # Tape to rebuild from on the first refresh().
+        self._rebuild_tape = None
+        self._rebuilding = False
+        self._rebuilt = False
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def mark_dirty(self, start, end=None):
+        """Report changed blocks. Called from the audio callback."""
+        self._dirty.add(start, end)
+
+    def rebuild(self, tape, peaks=None):
+        """Compute all peaks from scratch.
+
+        peaks can be the peak of every block if they are already known,
+        for example from a session file.
+        """
+        # Changes made while the tape is read are left for refresh().
+        self._rebuild_tape = None
+        self._dirty.clear()
+        if peaks is not None:
+            base = array.array('H', peaks)
+        else:
+            base = array.array('H')
+            for data in tape.iter_chunks():
+                peaks = mixing.get_block_peaks(data, self.bytes_per_block)
+                base.extend(peaks)
+
+        with self._lock:
+            self.levels = [base]
+            self._update_levels(range(len(base)))
+
+    def rebuild_later(self, tape):
+        """Like rebuild() but run in a background thread.
+
+        The rebuild starts on the first refresh(), so nothing is read if
+        the overview is not drawn. Until it's done refresh() returns no
+        changes, and after that it returns all positions once.
+        """
+        self._rebuild_tape = tape
+
+    def _rebuild_in_background(self, tape):
+        self.rebuild(tape)
+        self._rebuilt = True
+        self._rebuilding = False
+
+    def refresh(self, read, length):
+        """Recompute the peaks of changed blocks.
+
+        read(pos) returns the block at pos and length is the length of
+        the tape. Returns the set of positions that were recomputed.
+        Blocks cut off the end are not included.
+        """
+        if self._rebuild_tape is not None:
+            tape, self._rebuild_tape = self._rebuild_tape, None
+            self._rebuilding = True
+            start_thread(lambda: self._rebuild_in_background(tape))
+        if self._rebuilding:
+            return set()
+
+        positions = self._dirty.pop(length)
+        base = self.levels[0]
+        old_length = len(base)
+        if self._rebuilt:
+            # Nothing is recomputed for these, they're just new.
+            self._rebuilt = False
+            rebuilt = set(range(min(old_length, length)))
+        else:
+            rebuilt = set()
+        if not positions and length == old_length:
+            return positions | rebuilt
+
+        with self._lock:
+            if length > old_length:
+                base.frombytes(bytes(2 * (length - old_length)))
+                positions.update(range(old_length, length))
+            elif length < old_length:
+                del base[length:]
+                if length > 0:
+                    positions.add(length - 1)
+
+            for pos in positions:
+                base[pos] = mixing.get_max_value(read(pos))
+
+            self._update_levels(positions)
+
+        return positions | rebuilt
+
+    def _update_levels(self, dirty):
+        # Must be called with the lock held.
+        factor = self.factor
+        level = 1
+
+        while len(self.levels[level - 1]) > 1:
+            below = self.levels[level - 1]
+            size = -(-len(below) // factor)
+
+            if level == len(self.levels):
+                self.levels.append(array.array('H'))
+            entries = self.levels[level]
+            if size > len(entries):
+                entries.frombytes(bytes(2 * (size - len(entries))))
+            else:
+                del entries[size:]
+
+            dirty = {i // factor for i in dirty}
+            for i in dirty:
+                entries[i] = max(below[i * factor : (i + 1) * factor])
+
+            level += 1
+
+        del self.levels[level:]
+
+    def get(self, start, end, columns):
+        """Return columns peaks (0..1) covering blocks start to end."""
+        blocks_per_column = (end - start) / columns
+
+        level = 0
+        scale = 1
+        while (
+            level + 1 < len(self.levels)
+            and scale * self.factor <= blocks_per_column
+        ):
+            level += 1
+            scale *= self.factor
+
+        with self._lock:
+            entries = self.levels[level]
+            peaks = []
+            for column in range(columns):
+                first = int(start + column * blocks_per_column)
+                last = int(start + (column + 1) * blocks_per_column)
+                first //= scale
+                last = -(-last // scale)
+                segment = entries[max(first, 0) : max(last, first + 1)]
+                peaks.append(max(segment, default=0) / mixing.max_sample)
+
+        return peaks
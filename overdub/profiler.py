@@ -0,0 +1,92 @@
+"""Timing and xrun counters for the audio callback.
+
+This is always on, so recording a callback only does a few integer and
+float operations. Anything more expensive (like the max over the
+window) is computed when someone asks for it.
+"""
+import array
+
+# Bucket i counts callbacks that took less than 2**i microseconds.
+num_buckets = 24
+
+trace_fields = ['start', 'duration', 'drain', 'output_delay', 'xrun']
+
+
+class CallbackProfiler:
+    def __init__(self, budget, window=256, trace=False):
+        """budget is the time in seconds of one block."""
+        self.budget = budget
+        self.count = 0
+        self.histogram = [0] * num_buckets
+
+        self.input_underflows = 0
+        self.input_overflows = 0
+        self.output_underflows = 0
+        self.output_overflows = 0
+
+        # Time spent running commands in the last callback.
+        self.drain_time = 0.0
+
+        self._window = array.array('d', bytes(8 * window))
+        self._trace = array.array('d') if trace else None
+
+    def record(self, start, end, status=None, output_delay=0.0):
+        """Record one callback.
+
+        start and end are perf_counter() values. status is the
+        sounddevice.CallbackFlags passed to the callback.
+        """
+        duration = end - start
+
+        micros = int(duration * 1e6)
+        self.histogram[min(micros.bit_length(), num_buckets - 1)] += 1
+        self._window[self.count % len(self._window)] = duration
+        self.count += 1
+
+        xrun = 0
+        if status:
+            xruns = self.xruns
+            if status.input_underflow:
+                self.input_underflows += 1
+            if status.input_overflow:
+                self.input_overflows += 1
+            if status.output_underflow:
+                self.output_underflows += 1
+            if status.output_overflow:
+                self.output_overflows += 1
+            xrun = self.xruns - xruns
+
+        if self._trace is not None:
+            self._trace.extend(
+                (start, duration, self.drain_time, output_delay, xrun)
+            )
+
+    @property
+    def xruns(self):
+        return (
+            self.input_underflows
+            + self.input_overflows
+            + self.output_underflows
+            + self.output_overflows
+        )
+
+    def window_max(self):
+        """Return the longest callback time in the window."""
+        return max(self._window)
+
+    def load(self):
+        """Return the longest callback time as a fraction of the budget."""
+        return self.window_max() / self.budget
+
+    def dump_trace(self, filename):
+        """Write the trace to a CSV file (times are in seconds)."""
+        if self._trace is None:
+            return
+
+        trace = self._trace
+        width = len(trace_fields)
+
+        with open(filename, 'w') as outfile:
+            print(','.join(trace_fields), file=outfile)
+            for i in range(0, len(trace), width):
+                print(','.join(map(repr, trace[i : i + width])), file=outfile)
@@ -1,25 +1,65 @@
-import meep
 from .threads import start_thread
+from . import midi
+
+device_name = 'microkey'
+
+
+def handle_cc(deck, control, value):
+    if control == 64:
+        if value == 127:
+            deck.punch_in()
+        elif value == 0:
+            deck.punch_out()
+
+
+def attach(inputs, deck):
+    """Read the pedal from an inputs.InputLoop using raw ALSA MIDI.
+
+    Returns the reader or None if the device was not found.
+    """
+    filename = midi.find_device(device_name)
+    if filename is None:
+        return None
+
+    reader = midi.MidiReader(filename)
+
+    def on_readable():
+        try:
+            messages = reader.read_messages()
+        except OSError:
+            # Unplugged.
+            inputs.remove_reader(reader)
+            reader.close()
+            return
+
+        for status, *data in messages:
+            if status & 0xF0 == 0xB0:
+                handle_cc(deck, *data)
+
+    inputs.add_reader(reader, on_readable)
+    return reader
 
 
 def _is_connected():
+    import meep
+
     for name in meep.list_inputs():
-        if 'microkey' in name.lower():
+        if device_name in name.lower():
             return True
     else:
         return False
 
 
 def start(deck):
+    """Read the pedal with meep in a thread of its own."""
+    import meep
+
     def handle_pedal():
-        port = meep.open_input('microkey')
+        port = meep.open_input(device_name)
 
         for msg in port:
             if msg.is_cc(64):
-                if msg.value == 127:
-                    deck.punch_in()
-                elif msg.value == 0:
-                    deck.punch_out()
+                handle_cc(deck, 64, msg.value)
 
     if _is_connected():
         return start_thread(handle_pedal)
@@ -0,0 +1,554 @@
+"""Compressed session files (.ovd).
+
+The audio is stored as separately compressed chunks of blocks, with an
+index of where each chunk is in the file, so any block can be found
+without reading what comes before it. Silent chunks take no space. The
+peak of every block is stored as well so the overview can be drawn
+without decoding the audio.
+
+Layout (little endian)::
+
+    header
+    chunk data ...
+    index: (offset, size, compressed) per chunk, size 0 for silence
+    peaks: compressed array of 16 bit peaks, one per block
+
+Chunks are compressed and decompressed on a thread pool. zlib and lzma
+release the GIL, so this uses all cores.
+
+Saving changes appends the changed chunks and a new index to the end
+of the file and then updates the header, so the file is valid at every
+point. The file is rewritten when more than half of it is unused.
+"""
+import os
+import lzma
+import zlib
+import array
+import struct
+import functools
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from . import audio
+from . import mixing
+from .tape import Tape
+
+extension = '.ovd'
+
+header = struct.Struct('<4sHHHIIIQQQQ')
+index_entry = struct.Struct('<QIB')
+magic = b'OVDS'
+version = 1
+
+# Audio doesn't compress much, so zlib is run at its fastest level.
+codecs = {
+    'raw': (0, bytes, bytes),
+    'zlib': (1, functools.partial(zlib.compress, level=1), zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+_codecs_by_id = {codec[0]: codec for codec in codecs.values()}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(thread_name_prefix='session')
+        return _executor
+
+
+def _map(func, items, window=16):
+    """Like map() but runs func on the thread pool.
+
+    Results are yielded in order. At most window items are in flight,
+    so large tapes aren't held in memory twice.
+    """
+    executor = _get_executor()
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def is_session_file(filename):
+    return filename.endswith(extension)
+
+
+class SessionFile:
+    """Random access to the chunks of a session file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._read_header()
+        except (struct.error, ValueError):
+            self._file.close()
+            raise
+
+    def _read_header(self):
+        data = self._file.read(header.size)
+        if len(data) < header.size or data[:4] != magic:
+            raise ValueError(f'{self.filename}: not a session file')
+
+        (
+            _,
+            file_version,
+            codec_id,
+            self.channels,
+            self.frame_rate,
+            self.frames_per_block,
+            self.blocks_per_chunk,
+            self.length,
+            index_offset,
+            peaks_offset,
+            peaks_size,
+        ) = header.unpack(data)
+
+        if file_version != version or codec_id not in _codecs_by_id:
+            raise ValueError(f'{self.filename}: unsupported session file')
+
+        self.codec_id = codec_id
+        _, _, self._decompress = _codecs_by_id[codec_id]
+        self.bytes_per_block = (
+            self.frames_per_block * self.channels * audio.sample_size
+        )
+        self.bytes_per_chunk = self.bytes_per_block * self.blocks_per_chunk
+
+        nchunks = -(-self.length // self.blocks_per_chunk)
+        data = self._pread(nchunks * index_entry.size, index_offset)
+        self.index = list(index_entry.iter_unpack(data))
+
+        self.peaks = array.array('H')
+        self.peaks.frombytes(
+            self._decompress(self._pread(peaks_size, peaks_offset))
+        )
+
+    def _pread(self, size, offset):
+        data = os.pread(self._file.fileno(), size, offset)
+        if len(data) < size:
+            raise ValueError(f'{self.filename}: file is truncated')
+        return data
+
+    def __len__(self):
+        return len(self.index)
+
+    def check_format(self, fmt):
+        if (self.frame_rate, self.channels) != (fmt.frame_rate, fmt.channels):
+            raise ValueError(
+                f'{self.filename}: expected {fmt.frame_rate} Hz '
+                f'{fmt.channels} channel audio'
+            )
+
+    def read_encoded(self, chunk):
+        """Return (data, compressed) for a chunk. data is empty if silent."""
+        offset, size, compressed = self.index[chunk]
+        return self._pread(size, offset) if size else b'', compressed
+
+    def read_chunk(self, chunk):
+        """Return a chunk as a full size bytearray, or None if silent."""
+        encoded, compressed = self.read_encoded(chunk)
+        if not encoded:
+            return None
+
+        if compressed:
+            data = bytearray(self._decompress(encoded))
+        else:
+            data = bytearray(encoded)
+        if len(data) < self.bytes_per_chunk:
+            # The last chunk is padded with silence.
+            data.extend(bytes(self.bytes_per_chunk - len(data)))
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def read_format(filename, frames_per_block=audio.frames_per_block):
+    """Return the Format of a session file."""
+    session = SessionFile(filename)
+    session.close()
+    return audio.Format(
+        frame_rate=session.frame_rate,
+        channels=session.channels,
+        frames_per_block=frames_per_block,
+    )
+
+
+class SessionTape(Tape):
+    """A tape that decodes chunks of a session file as they're used.
+
+    The first read of a chunk decodes it and queues the next few chunks
+    on the thread pool, so during playback chunks are normally ready by
+    the time they're reached.
+    """
+
+    def __init__(self, session, read_ahead=4):
+        super().__init__(session.bytes_per_block, session.blocks_per_chunk)
+        self.session = session
+        self.read_ahead = read_ahead
+        self.peaks = session.peaks
+
+        self._chunks = [None] * len(session)
+        self._length = session.length
+        # Chunks not decoded yet and their futures if they are queued.
+        # Silent chunks are left out since they are already in place.
+        self._pending = {
+            chunk: None
+            for chunk, (_, size, _) in enumerate(session.index)
+            if size
+        }
+        self._lock = threading.Lock()
+
+    def _ensure(self, chunk):
+        pending = self._pending
+        if pending.get(chunk + self.read_ahead, False) is None:
+            with self._lock:
+                for i in range(chunk + 1, chunk + 1 + self.read_ahead):
+                    if pending.get(i, False) is None:
+                        pending[i] = _get_executor().submit(
+                            self.session.read_chunk, i
+                        )
+
+        if chunk not in pending:
+            return
+
+        with self._lock:
+            future = pending.get(chunk)
+        if future is None or future.cancel():
+            data = self.session.read_chunk(chunk)
+        else:
+            data = future.result()
+
+        # Only the first one to get here installs the chunk, so nothing
+        # written to it in the meantime is lost.
+        with self._lock:
+            if chunk in pending:
+                self._chunks[chunk] = data
+                del pending[chunk]
+
+    def is_decoded(self, chunk):
+        return chunk not in self._pending
+
+    def read(self, pos):
+        if 0 <= pos < self._length:
+            self._ensure(pos // self.blocks_per_chunk)
+        return super().read(pos)
+
+    def _get_view(self, pos, block):
+        self._ensure(pos // self.blocks_per_chunk)
+        return super()._get_view(pos, block)
+
+    def extend(self, data):
+        self._ensure(self._length // self.blocks_per_chunk)
+        super().extend(data)
+
+    def truncate(self, length):
+        if length >= self._length:
+            return
+
+        chunk = length // self.blocks_per_chunk
+        self._ensure(chunk)
+        with self._lock:
+            for i in [i for i in self._pending if i >= chunk]:
+                del self._pending[i]
+        super().truncate(length)
+
+    def iter_chunks(self):
+        for chunk in range(len(self._chunks)):
+            self._ensure(chunk)
+        return super().iter_chunks()
+
+
+def open_tape(filename, fmt=audio.default_format):
+    """Open a session file as a tape.
+
+    If the file was saved with the same block size the chunks are
+    decoded as they are used, otherwise everything is loaded now.
+    """
+    session = SessionFile(filename)
+    session.check_format(fmt)
+    if session.frames_per_block == fmt.frames_per_block:
+        return SessionTape(session)
+    else:
+        session.close()
+        return load(filename, fmt)
+
+
+def iter_load(filename, fmt=audio.default_format):
+    """Decode a session file in large chunks.
+
+    Yields buffers of one or more whole blocks. The last one is padded
+    with silence.
+    """
+    session = SessionFile(filename)
+    session.check_format(fmt)
+    bytes_per_block = fmt.bytes_per_block
+    remaining = session.length * session.bytes_per_block
+    rest = bytearray()
+
+    try:
+        for data in _map(session.read_chunk, range(len(session))):
+            if data is None:
+                data = bytes(session.bytes_per_chunk)
+            data = memoryview(data)[:remaining]
+            remaining -= len(data)
+
+            # The file may use a different block size.
+            if rest:
+                rest += data
+                data = rest
+            size = len(data) - len(data) % bytes_per_block
+            if size:
+                yield memoryview(data)[:size]
+            rest = bytearray(data[size:])
+    finally:
+        session.close()
+
+    if rest:
+        rest += fmt.silence[: bytes_per_block - len(rest)]
+        yield memoryview(rest)
+
+
+def load(filename, fmt=audio.default_format, tape=None):
+    """Decode a session file into a tape.
+
+    The data is appended to tape if passed, otherwise to a new Tape.
+    """
+    if tape is None:
+        tape = Tape(fmt.bytes_per_block)
+
+    for data in iter_load(filename, fmt):
+        tape.extend(data)
+
+    return tape
+
+
+def _encode(job):
+    codec, bytes_per_block, data = job
+    if isinstance(data, tuple):
+        # Already encoded.
+        return data
+
+    _, compress, _ = codecs[codec]
+    peaks = array.array('H', mixing.get_block_peaks(data, bytes_per_block))
+    if not any(peaks):
+        return b'', False, peaks
+
+    # Chunks that don't get smaller are stored as they are.
+    encoded = compress(data)
+    if len(encoded) < len(data):
+        return encoded, True, peaks
+    else:
+        return data, False, peaks
+
+
+def _read_chunk(tape, chunk, blocks_per_chunk):
+    start = chunk * blocks_per_chunk
+    end = min(start + blocks_per_chunk, len(tape))
+    return b''.join(tape.read(pos) for pos in range(start, end))
+
+
+def _iter_jobs(tape, fmt, codec, blocks_per_chunk, chunks):
+    """Yield jobs for _encode() for chunks of tape.
+
+    Chunks of a SessionTape that haven't been decoded are copied as
+    they are if they use the same codec.
+    """
+    codec_id, _, _ = codecs[codec]
+    session = getattr(tape, 'session', None)
+    copy = (
+        session is not None
+        and session.codec_id == codec_id
+        and session.frames_per_block == fmt.frames_per_block
+        and session.blocks_per_chunk == blocks_per_chunk
+    )
+
+    for chunk in chunks:
+        if copy and not tape.is_decoded(chunk):
+            start = chunk * blocks_per_chunk
+            peaks = session.peaks[start : start + blocks_per_chunk]
+            data = (*session.read_encoded(chunk), peaks)
+        else:
+            data = _read_chunk(tape, chunk, blocks_per_chunk)
+        yield codec, fmt.bytes_per_block, data
+
+
+def _write_chunks(outfile, jobs):
+    """Write encoded chunks and return their index entries and peaks."""
+    entries = []
+    peaks = array.array('H')
+    for encoded, compressed, chunk_peaks in _map(_encode, jobs):
+        entries.append((outfile.tell(), len(encoded), compressed))
+        outfile.write(encoded)
+        peaks.extend(chunk_peaks)
+    return entries, peaks
+
+
+def _write_tail(outfile, fmt, codec, blocks_per_chunk, length, index, peaks):
+    """Write index and peaks at the end of the file and update the header."""
+    codec_id, compress, _ = codecs[codec]
+
+    outfile.seek(0, os.SEEK_END)
+    index_offset = outfile.tell()
+    outfile.writelines(index_entry.pack(*entry) for entry in index)
+
+    peaks_offset = outfile.tell()
+    data = compress(peaks.tobytes())
+    outfile.write(data)
+    outfile.flush()
+    os.fsync(outfile.fileno())
+
+    outfile.seek(0)
+    outfile.write(
+        header.pack(
+            magic,
+            version,
+            codec_id,
+            fmt.channels,
+            fmt.frame_rate,
+            fmt.frames_per_block,
+            blocks_per_chunk,
+            length,
+            index_offset,
+            peaks_offset,
+            len(data),
+        )
+    )
+    outfile.flush()
+    os.fsync(outfile.fileno())
+
+
+def save(filename, tape, fmt=audio.default_format, codec='zlib'):
+    """Write a tape to a session file."""
+    blocks_per_chunk = getattr(tape, 'blocks_per_chunk', 256)
+    if not isinstance(tape, SessionTape):
+        # iter_chunks() is safe during playback, also for a Mixdown.
+        save_stream(filename, tape.iter_chunks(), fmt, codec, blocks_per_chunk)
+        return
+
+    chunks = range(-(-len(tape) // blocks_per_chunk))
+    jobs = _iter_jobs(tape, fmt, codec, blocks_per_chunk, chunks)
+    _write_file(filename, fmt, codec, blocks_per_chunk, jobs)
+
+
+def save_stream(
+    filename,
+    buffers,
+    fmt=audio.default_format,
+    codec='zlib',
+    blocks_per_chunk=256,
+):
+    """Write buffers of one or more whole blocks to a session file.
+
+    Only a few chunks are held in memory at a time.
+    """
+    bytes_per_chunk = fmt.bytes_per_block * blocks_per_chunk
+    jobs = (
+        (codec, fmt.bytes_per_block, chunk)
+        for chunk in rechunk(buffers, bytes_per_chunk)
+    )
+    _write_file(filename, fmt, codec, blocks_per_chunk, jobs)
+
+
+def rechunk(buffers, size):
+    """Yield copies of the data in buffers in pieces of size bytes.
+
+    The pieces are copied since they are compressed on other threads
+    while the buffers may change.
+    """
+    rest = bytearray()
+    for data in buffers:
+        if not rest and len(data) == size:
+            yield bytes(data)
+            continue
+
+        rest += data
+        while len(rest) >= size:
+            yield bytes(rest[:size])
+            del rest[:size]
+
+    if rest:
+        yield bytes(rest)
+
+
+def _write_file(filename, fmt, codec, blocks_per_chunk, jobs):
+    # Written next to the old file and then moved over it, so a
+    # SessionTape reading from the old file can still be saved.
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as outfile:
+        outfile.write(bytes(header.size))
+        index, peaks = _write_chunks(outfile, jobs)
+        _write_tail(
+            outfile, fmt, codec, blocks_per_chunk, len(peaks), index, peaks
+        )
+    os.replace(temp_filename, filename)
+
+
+def save_changed(
+    filename, tape, positions, fmt=audio.default_format, codec='zlib'
+):
+    """Write changed blocks to a session file written earlier from tape.
+
+    Falls back to save() if the file can't be updated or has too much
+    unused space.
+    """
+    try:
+        session = SessionFile(filename)
+    except (OSError, ValueError):
+        save(filename, tape, fmt, codec)
+        return
+    session.close()
+
+    blocks_per_chunk = session.blocks_per_chunk
+    compatible = (
+        session.codec_id == codecs[codec][0]
+        and (session.frame_rate, session.channels)
+        == (fmt.frame_rate, fmt.channels)
+        and session.frames_per_block == fmt.frames_per_block
+        and getattr(tape, 'blocks_per_chunk', 256) == blocks_per_chunk
+    )
+    if not compatible:
+        save(filename, tape, fmt, codec)
+        return
+
+    length = len(tape)
+    nchunks = -(-length // blocks_per_chunk)
+    changed = {pos // blocks_per_chunk for pos in positions if pos < length}
+    if length != session.length:
+        first = min(length, session.length) // blocks_per_chunk
+        changed.update(range(first, nchunks))
+
+    index = session.index[:nchunks]
+    index.extend([(0, 0, False)] * (nchunks - len(index)))
+    kept = sum(entry[1] for i, entry in enumerate(index) if i not in changed)
+    changed = sorted(changed)
+    if os.path.getsize(filename) > 2 * kept + session.bytes_per_chunk:
+        save(filename, tape, fmt, codec)
+        return
+
+    peaks = session.peaks[:length]
+    peaks.frombytes(bytes(2 * (length - len(peaks))))
+    jobs = _iter_jobs(tape, fmt, codec, blocks_per_chunk, changed)
+
+    with open(filename, 'r+b') as outfile:
+        outfile.seek(0, os.SEEK_END)
+        entries, new_peaks = _write_chunks(outfile, jobs)
+
+        start = 0
+        for chunk, entry in zip(changed, entries):
+            index[chunk] = entry
+            count = min(blocks_per_chunk, length - chunk * blocks_per_chunk)
+            first = chunk * blocks_per_chunk
+            peaks[first : first + count] = new_peaks[start : start + count]
+            start += count
+
+        _write_tail(
+            outfile, fmt, codec, blocks_per_chunk, length, index, peaks
+        )
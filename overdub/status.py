@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Tuple
 
 
 @dataclass(frozen=True)
@@ -8,3 +9,17 @@ class Status:
     mode: str = 'stopped'
     solo: bool = False
     meter: float = 0
+    # Peak and RMS level per channel (0..1).
+    peaks: Tuple[float, ...] = ()
+    rms: Tuple[float, ...] = ()
+    dropped_commands: int = 0
+    coalesced_commands: int = 0
+    # Longest callback time in seconds over the last few hundred blocks
+    # and the same as a fraction of the block time.
+    callback_max: float = 0
+    callback_load: float = 0
+    callback_histogram: Tuple[int, ...] = ()
+    drain_time: float = 0
+    xruns: int = 0
+    # Loop start and end in seconds, if cycling.
+    loop: Tuple[float, ...] = ()
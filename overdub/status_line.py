@@ -12,7 +12,13 @@ def format_time(seconds):
     return f'{minutes:d}:{seconds:02d}:{decimals:02d}'
 
 
-def format_status(status):
+def format_stats(status):
+    load = int(status.callback_load * 100)
+    drain = status.drain_time * 1e6
+    return f'cpu {load}% xruns {status.xruns} cmd {drain:.0f}us'
+
+
+def format_status(status, stats=False):
     time = format_time(status.time)
     end = format_time(status.end)
 
@@ -21,15 +27,23 @@ def format_status(status):
     if status.solo:
         flags += 's'
 
+    if status.loop:
+        flags += 'c'
+
     if flags:
         flags = ' ' + flags
 
     meter = ('|' * int(status.meter * 20)).ljust(20)
 
-    return f'{time} / {end} {status.mode}{flags} [{meter}]'
+    line = f'{time} / {end} {status.mode}{flags} [{meter}]'
+
+    if stats:
+        line += ' ' + format_stats(status)
+
+    return line
 
 
-def _fake_status_for_screenshot(status):
+def _fake_status_for_screenshot(status, stats=False):
     """Return a fake status line for screenshots."""
     return {
         'stopped': '0:00:00 / 3:42:37 stopped [||                  ]',
@@ -0,0 +1,456 @@
+import os
+import mmap
+from . import mixing
+from . import wavfile
+
+
+class Tape:
+    """A growable track of audio stored as contiguous chunks of blocks.
+
+    Chunks are bytearrays that are allocated the first time something
+    other than silence is written to them, so they never need to be
+    moved or resized. Reads return memoryviews into the chunks.
+    """
+
+    def __init__(self, bytes_per_block, blocks_per_chunk=256):
+        self.bytes_per_block = bytes_per_block
+        self.blocks_per_chunk = blocks_per_chunk
+        self.bytes_per_chunk = bytes_per_block * blocks_per_chunk
+        self.silence = bytes(bytes_per_block)
+
+        self._chunks = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for pos in range(self._length):
+            yield self.read(pos)
+
+    def _set_length(self, length):
+        self._length = length
+
+    def _locate(self, pos):
+        chunk, index = divmod(pos, self.blocks_per_chunk)
+        start = index * self.bytes_per_block
+        return chunk, start, start + self.bytes_per_block
+
+    def _get_view(self, pos, block):
+        """Return a writable view of the block at pos.
+
+        Returns None if the block is silent and the block to write is
+        silent, to avoid allocating chunks for silence.
+        """
+        chunk, start, end = self._locate(pos)
+
+        if chunk >= len(self._chunks):
+            self._chunks.extend([None] * (chunk + 1 - len(self._chunks)))
+
+        if self._chunks[chunk] is None:
+            if block == self.silence:
+                return None
+            self._chunks[chunk] = bytearray(self.bytes_per_chunk)
+
+        return memoryview(self._chunks[chunk])[start:end]
+
+    def read(self, pos):
+        """Return the block at pos or silence if there's nothing there."""
+        if 0 <= pos < self._length:
+            chunk, start, end = self._locate(pos)
+            data = self._chunks[chunk]
+            if data is not None:
+                return memoryview(data)[start:end]
+
+        return self.silence
+
+    def write(self, pos, block, offset=0):
+        """Overwrite the block at pos, growing the tape if needed.
+
+        If offset is given the data is written that many bytes into the
+        block. It must not go past the end of the block.
+        """
+        view = self._get_view(pos, block)
+        if view is not None:
+            view[offset : offset + len(block)] = block
+        if pos >= self._length:
+            self._set_length(pos + 1)
+
+    def mix(self, pos, block, offset=0):
+        """Add block to the block at pos, growing the tape if needed."""
+        if pos >= self._length:
+            self.write(pos, block, offset)
+        else:
+            view = self._get_view(pos, block)
+            if view is not None:
+                mixing.mix_into(view[offset : offset + len(block)], block)
+
+    def append(self, block):
+        self.write(self._length, block)
+
+    def extend(self, data):
+        """Append a buffer of one or more whole blocks."""
+        data = memoryview(data).cast('B')
+        pos = self._length
+        offset = 0
+
+        while offset < len(data):
+            chunk, start, _ = self._locate(pos)
+            size = min(len(data) - offset, self.bytes_per_chunk - start)
+
+            if chunk >= len(self._chunks):
+                self._chunks.extend([None] * (chunk + 1 - len(self._chunks)))
+            if self._chunks[chunk] is None:
+                self._chunks[chunk] = bytearray(self.bytes_per_chunk)
+
+            view = memoryview(self._chunks[chunk])
+            view[start : start + size] = data[offset : offset + size]
+            offset += size
+            pos += size // self.bytes_per_block
+
+        self._set_length(pos)
+
+    def truncate(self, length):
+        """Cut the tape down to length blocks."""
+        if length >= self._length:
+            return
+
+        chunk, start, _ = self._locate(length)
+        if start > 0 and self._chunks[chunk] is not None:
+            data = self._chunks[chunk]
+            data[start:] = bytes(len(data) - start)
+            chunk += 1
+
+        for i in range(chunk, len(self._chunks)):
+            self._chunks[i] = None
+
+        self._set_length(length)
+
+    def iter_chunks(self):
+        """Yield the contents of the tape as a few large buffers."""
+        silent_chunk = None
+        remaining = self._length * self.bytes_per_block
+
+        for data in self._chunks:
+            if remaining <= 0:
+                break
+
+            if data is None:
+                if silent_chunk is None:
+                    silent_chunk = bytes(self.bytes_per_chunk)
+                data = silent_chunk
+
+            yield memoryview(data)[:remaining]
+            remaining -= self.bytes_per_chunk
+
+
+def _is_zero_from(file, offset, chunk_size=2**20):
+    """Return True if the file has only zero bytes from offset on."""
+    file.seek(offset)
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            return True
+        elif data.count(0) != len(data):
+            return False
+
+
+class MappedTape(Tape):
+    """A tape that maps the data chunk of a WAV file into memory.
+
+    Playback reads straight from the mapping and overdubs are written in
+    place. When the tape grows the file is extended in large steps and
+    the header is updated, so saving is just a flush.
+    """
+
+    def __init__(
+        self,
+        filename,
+        bytes_per_block,
+        nchannels=2,
+        sampwidth=2,
+        framerate=44100,
+        grow_blocks=2048,
+    ):
+        super().__init__(bytes_per_block)
+        self.filename = filename
+        self.grow_blocks = grow_blocks
+
+        if os.path.exists(filename):
+            self._file = open(filename, 'r+b')
+            fmt = wavfile.read_header(self._file)
+            if fmt[:3] != (nchannels, sampwidth, framerate):
+                self._file.close()
+                raise ValueError(f'{filename}: unsupported audio format')
+            self._data_offset, data_size = fmt[3:]
+            # Zeros after the data are room left by _reserve() in a file
+            # that wasn't closed.
+            if not _is_zero_from(self._file, self._data_offset + data_size):
+                self._file.close()
+                raise ValueError(f'{filename}: data chunk is not last in file')
+        else:
+            self._file = open(filename, 'w+b')
+            header = wavfile.make_header(nchannels, sampwidth, framerate, 0)
+            self._file.write(header)
+            self._data_offset = len(header)
+            data_size = 0
+
+        # A partial block at the end is padded with silence.
+        blocks, rest = divmod(data_size, bytes_per_block)
+        self._length = blocks + (rest > 0)
+        self._capacity = 0
+        self._map = None
+        self._view = None
+        self._reserve(self._length)
+        wavfile.update_sizes(
+            self._map, self._data_offset, self._length * bytes_per_block
+        )
+
+    def _reserve(self, capacity):
+        """Make sure the mapping has room for capacity blocks."""
+        if capacity <= self._capacity and self._map is not None:
+            return
+
+        capacity = max(capacity, self._capacity + self.grow_blocks)
+        size = self._data_offset + capacity * self.bytes_per_block
+        self._file.flush()
+        os.ftruncate(self._file.fileno(), size)
+
+        # Don't close the old map here since there may still be views of
+        # it around. It will be closed when the last view goes away.
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._view = memoryview(self._map)
+        self._capacity = capacity
+
+    def _set_length(self, length):
+        self._length = length
+        wavfile.update_sizes(
+            self._map, self._data_offset, length * self.bytes_per_block
+        )
+
+    def _locate(self, pos):
+        start = self._data_offset + pos * self.bytes_per_block
+        return start, start + self.bytes_per_block
+
+    def _get_view(self, pos, block):
+        self._reserve(pos + 1)
+        start, end = self._locate(pos)
+        return self._view[start:end]
+
+    def read(self, pos):
+        if 0 <= pos < self._length:
+            start, end = self._locate(pos)
+            return self._view[start:end]
+        else:
+            return self.silence
+
+    def extend(self, data):
+        data = memoryview(data).cast('B')
+        length = self._length + len(data) // self.bytes_per_block
+        self._reserve(length)
+
+        start, _ = self._locate(self._length)
+        self._view[start : start + len(data)] = data
+        self._set_length(length)
+
+    def iter_chunks(self):
+        start = self._data_offset
+        end = start + self._length * self.bytes_per_block
+
+        for pos in range(start, end, self.bytes_per_chunk):
+            yield self._view[pos : min(pos + self.bytes_per_chunk, end)]
+
+    def truncate(self, length):
+        if length >= self._length:
+            return
+
+        # Clear the cut off part so it's silent if the tape grows again.
+        start, _ = self._locate(length)
+        end, _ = self._locate(self._length)
+        zeros = bytes(self.bytes_per_chunk)
+        for pos in range(start, end, len(zeros)):
+            size = min(len(zeros), end - pos)
+            self._view[pos : pos + size] = zeros[:size]
+
+        self._set_length(length)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        """Flush and cut the file down to the size of the audio data."""
+        if self._map is None:
+            return
+
+        self.flush()
+        self._view.release()
+        self._map.close()
+        self._view = self._map = None
+
+        size = self._data_offset + self._length * self.bytes_per_block
+        os.ftruncate(self._file.fileno(), size)
+        self._file.close()
+
+
+class SparseTape:
+    """A tape that only stores blocks that are not silent.
+
+    Blocks are kept in a dict by position. Silent blocks are not
+    stored, so reading them costs nothing and recording onto them is a
+    plain copy. Blocks that become silent are dropped.
+
+    With dedup=True identical blocks share storage. Shared blocks are
+    immutable bytes objects and are copied before they are changed.
+    """
+
+    def __init__(self, bytes_per_block, blocks_per_chunk=256, dedup=False):
+        self.bytes_per_block = bytes_per_block
+        self.blocks_per_chunk = blocks_per_chunk
+        self.bytes_per_chunk = bytes_per_block * blocks_per_chunk
+        self.silence = bytes(bytes_per_block)
+        self.dedup = dedup
+
+        self._blocks = {}
+        self._length = 0
+        # Shared block contents and reference counts.
+        self._shared = {}
+        self._refcounts = {}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for pos in range(self._length):
+            yield self.read(pos)
+
+    @property
+    def stored_blocks(self):
+        """Number of blocks that take up memory."""
+        owned = [b for b in self._blocks.values() if type(b) is not bytes]
+        return len(self._shared) + len(owned)
+
+    def _release(self, pos):
+        """Remove the block at pos."""
+        block = self._blocks.pop(pos, None)
+        if type(block) is bytes:
+            self._refcounts[block] -= 1
+            if self._refcounts[block] == 0:
+                del self._refcounts[block]
+                del self._shared[block]
+
+    def _store(self, pos, block):
+        self._release(pos)
+
+        # Comparing a memoryview is much slower than a copy.
+        data = bytearray(block)
+        if data == self.silence:
+            return
+
+        if self.dedup:
+            data = bytes(data)
+            data = self._shared.setdefault(data, data)
+            self._refcounts[data] = self._refcounts.get(data, 0) + 1
+
+        self._blocks[pos] = data
+
+    def _modify(self, pos, func):
+        """Change the stored block at pos in place with func(view).
+
+        Shared blocks are copied first, and the block is dropped if it
+        ends up silent.
+        """
+        block = self._blocks[pos]
+        if type(block) is bytes:
+            block = bytearray(block)
+            self._release(pos)
+            self._blocks[pos] = block
+
+        func(memoryview(block))
+
+        if block == self.silence:
+            del self._blocks[pos]
+        elif self.dedup:
+            self._store(pos, self._blocks.pop(pos))
+
+    def read(self, pos):
+        """Return the block at pos or silence if there's nothing there."""
+        block = self._blocks.get(pos)
+        if block is None:
+            return self.silence
+        return memoryview(block)
+
+    def write(self, pos, block, offset=0):
+        """Overwrite the block at pos, growing the tape if needed.
+
+        If offset is given the data is written that many bytes into the
+        block. It must not go past the end of the block.
+        """
+        end = offset + len(block)
+
+        if offset == 0 and end == self.bytes_per_block:
+            self._store(pos, block)
+        elif pos in self._blocks:
+
+            def func(view):
+                view[offset:end] = block
+
+            self._modify(pos, func)
+        elif bytes(block) != self.silence[: len(block)]:
+            data = bytearray(self.bytes_per_block)
+            data[offset:end] = block
+            self._store(pos, data)
+
+        if pos >= self._length:
+            self._length = pos + 1
+
+    def mix(self, pos, block, offset=0):
+        """Add block to the block at pos, growing the tape if needed."""
+        if pos not in self._blocks or pos >= self._length:
+            self.write(pos, block, offset)
+        else:
+
+            def func(view):
+                mixing.mix_into(view[offset : offset + len(block)], block)
+
+            self._modify(pos, func)
+
+    def append(self, block):
+        self.write(self._length, block)
+
+    def extend(self, data):
+        """Append a buffer of one or more whole blocks."""
+        data = memoryview(data).cast('B')
+        for start in range(0, len(data), self.bytes_per_block):
+            self.append(data[start : start + self.bytes_per_block])
+
+    def truncate(self, length):
+        """Cut the tape down to length blocks."""
+        if length >= self._length:
+            return
+
+        for pos in [pos for pos in self._blocks if pos >= length]:
+            self._release(pos)
+        self._length = length
+
+    def iter_chunks(self):
+        """Yield the contents of the tape as a few large buffers."""
+        silent_chunk = bytes(self.bytes_per_chunk)
+
+        for start in range(0, self._length, self.blocks_per_chunk):
+            end = min(start + self.blocks_per_chunk, self._length)
+            size = (end - start) * self.bytes_per_block
+
+            # The audio callback may drop and put back blocks meanwhile,
+            # so a block that is gone is taken as silence.
+            get = self._blocks.get
+            blocks = [(pos, get(pos)) for pos in range(start, end)]
+            blocks = [(pos, block) for pos, block in blocks if block]
+            if not blocks:
+                yield memoryview(silent_chunk)[:size]
+                continue
+
+            chunk = bytearray(size)
+            for pos, block in blocks:
+                offset = (pos - start) * self.bytes_per_block
+                chunk[offset : offset + self.bytes_per_block] = block
+            yield chunk
@@ -1,9 +1,9 @@
 import os
 import sys
-import time
 import fcntl
 import termios
 from contextlib import contextmanager
+from .inputs import InputLoop
 from .status_line import format_status
 
 
@@ -86,71 +86,124 @@ def make_minimalist_status_line(status):
     return f' {dot} {mode}'
 
 
-def get_event():
-    char = sys.stdin.read(1)
+keys = {
+    b'\x1b[C': 'wind',
+    b'\x1b[D': 'rewind',
+    b'q': 'quit',
+    b's': 'snapshot',
+    b'u': 'undo',
+    b'r': 'redo',
+    b'[': 'mark_loop_start',
+    b']': 'mark_loop_end',
+    b'l': 'clear_loop',
+    b'\n': 'toggle_record',
+    b' ': 'toggle_play',
+}
+
+
+def parse_keys(data):
+    """Yield events for the keys in data. Unknown keys are skipped."""
+    i = 0
+    while i < len(data):
+        if data[i : i + 1] == b'\x1b':
+            key = data[i : i + 3]
+        else:
+            key = data[i : i + 1]
+        i += len(key)
+
+        if key in keys:
+            yield keys[key]
 
-    if char == '\x1b':
-        code = sys.stdin.read(2)
-        if code == '[C':
-            return 'wind'
-        elif code == '[D':
-            return 'rewind'
-    elif char == 'q':
-        return 'quit'
-    elif char == 's':
-        return 'snapshot'
-    elif char == '\n':
-        return 'toggle_record'
-    elif char == ' ':
-        return 'toggle_play'
 
-    return None
+def read_events(fd):
+    try:
+        data = os.read(fd, 1024)
+    except BlockingIOError:
+        return []
+    return parse_keys(data)
 
 
-def get_events():
-    while event := get_event():
-        yield event
+def draw_status(status, minimalist, stats):
+    if minimalist:
+        update_line(make_minimalist_status_line(status))
+    else:
+        update_line('  ' + format_status(status, stats))
+
 
+def ui(deck, filename, minimalist=False, stats=False, inputs=None):
+    """Run the terminal UI.
 
-def ui(deck, filename, minimalist=False):
-    if os.path.exists(filename):
+    Keys are read by the inputs.InputLoop along with any other input
+    devices that have been attached to it.
+    """
+    if inputs is None:
+        inputs = InputLoop()
+
+    if os.path.exists(filename) or deck.mapped:
         deck.load(filename)
+    deck.start_autosave(filename)
+
+    # The status line shows hundredths of seconds, but 10 updates per
+    # second is plenty. Callback stats change all the time so they are
+    # redrawn every half second as well.
+    subscription = deck.notifier.subscribe(ticks_per_second=10)
+    fd = sys.stdin.fileno()
+
+    def redraw():
+        subscription.clear()
+        draw_status(deck.get_status(), minimalist, stats)
+
+    def on_keys():
+        for event in read_events(fd):
+            if event == 'quit':
+                inputs.stop()
+                return
+            elif event == 'snapshot':
+                update_line(f'Saving {filename}')
+                print()
+                deck.save(filename)
+            elif event == 'toggle_play':
+                deck.toggle_play()
+            elif event == 'toggle_record':
+                deck.toggle_record()
+            elif event == 'wind':
+                deck.skip(1)
+            elif event == 'rewind':
+                deck.skip(-1)
+            elif event == 'undo':
+                deck.undo()
+            elif event == 'redo':
+                deck.redo()
+            elif event == 'mark_loop_start':
+                deck.mark_loop_start()
+            elif event == 'mark_loop_end':
+                deck.mark_loop_end()
+            elif event == 'clear_loop':
+                deck.clear_loop()
+
+    inputs.add_reader(fd, on_keys)
+    inputs.add_reader(subscription, redraw)
+    if stats:
+        inputs.call_every(0.5, redraw)
 
     try:
         with term():
             deck.start_stream()
-            while True:
-                for event in get_events():
-                    if event == 'quit':
-                        return
-                    elif event == 'snapshot':
-                        update_line(f'Saving {filename}')
-                        print()
-                        deck.save(filename)
-                    elif event == 'toggle_play':
-                        deck.toggle_play()
-                    elif event == 'toggle_record':
-                        deck.toggle_record()
-                    elif event == 'wind':
-                        deck.skip(1)
-                    elif event == 'rewind':
-                        deck.skip(-1)
-
-                status = deck.get_status()
-                if minimalist:
-                    update_line(make_minimalist_status_line(status))
-                else:
-                    update_line('  ' + format_status(status))
-
-                time.sleep(0.05)
+            redraw()
+            inputs.run()
 
     except KeyboardInterrupt:
         pass
     finally:
+        inputs.remove_reader(fd)
+        inputs.remove_reader(subscription)
+        deck.notifier.unsubscribe(subscription)
         deck.stop_stream()
-        if len(deck.blocks) > 0:
+        subscription.close()
+        if len(deck.tape) > 0:
             update_line(f'Saving {filename}')
             deck.save(filename)
         else:
             update_line('Nothing to save')
+        deck.close()
         print()
@@ -0,0 +1,135 @@
+"""Waveform timeline for the Tk UI.
+
+The waveform is drawn from the deck's peak overview with one canvas
+line per column. Only the columns covering changed blocks are redrawn,
+so updating the timeline takes about the same time however long the
+tape is.
+"""
+import tkinter as tk
+
+waveform_color = '#8c8'
+playhead_color = 'white'
+recording_color = '#a00'
+pass_color = '#444'
+
+
+class Timeline:
+    def __init__(self, master, deck, width=800, height=120, min_seconds=60):
+        self.deck = deck
+        self.width = width
+        self.height = height
+
+        # The view covers the whole tape. It doubles in size when the
+        # tape grows past the end, so recording doesn't cause a full
+        # redraw every block.
+        self.min_blocks = deck.format.sec2block(min_seconds)
+        self.view_blocks = self.min_blocks
+        self.length = 0
+
+        self.canvas = tk.Canvas(
+            master,
+            width=width,
+            height=height,
+            background='black',
+            highlightthickness=0,
+        )
+        self.canvas.bind('<Configure>', self._on_configure)
+        self.canvas.bind('<Button-1>', self._on_click)
+
+        self._columns = []
+        self._regions = None
+        self._playhead = self.canvas.create_line(
+            0, 0, 0, height, fill=playhead_color
+        )
+        self._create_columns()
+
+    def pack(self, **kwargs):
+        self.canvas.pack(**kwargs)
+
+    def _on_configure(self, event):
+        if (event.width, event.height) != (self.width, self.height):
+            self.width = event.width
+            self.height = event.height
+            self._create_columns()
+            self._regions = None
+
+    def _on_click(self, event):
+        pos = event.x * self.view_blocks / self.width
+        self.deck.goto(self.deck.format.block2sec(pos))
+
+    def _x(self, pos):
+        return pos * self.width / self.view_blocks
+
+    def _create_columns(self):
+        self.canvas.delete('column')
+        self._columns = [
+            self.canvas.create_line(
+                x, 0, x, 0, fill=waveform_color, tags='column'
+            )
+            for x in range(self.width)
+        ]
+        self.canvas.tag_raise(self._playhead)
+        self._draw_columns(range(self.width))
+
+    def _draw_columns(self, columns):
+        overview = self.deck.overview
+        middle = self.height / 2
+        blocks_per_column = self.view_blocks / self.width
+
+        for x in columns:
+            start = x * blocks_per_column
+            [peak] = overview.get(start, start + blocks_per_column, 1)
+            size = min(peak, 1.0) * middle
+            self.canvas.coords(
+                self._columns[x], x, middle - size, x, middle + size + 1
+            )
+
+    def _draw_regions(self):
+        recording = self.deck.mode == 'recording'
+        regions = [tuple(region) for region in self.deck.pass_regions]
+
+        key = (regions, recording, self.view_blocks, self.width)
+        if key == self._regions:
+            return
+        self._regions = key
+
+        self.canvas.delete('pass')
+        for start, end in regions:
+            self.canvas.create_rectangle(
+                self._x(start),
+                0,
+                self._x(end),
+                self.height,
+                fill=recording_color if recording else pass_color,
+                width=0,
+                tags='pass',
+            )
+        self.canvas.tag_lower('pass')
+
+    def _draw_playhead(self):
+        x = self._x(self.deck.pos)
+        self.canvas.coords(self._playhead, x, 0, x, self.height)
+
+    def update(self):
+        changed = self.deck.update_overview()
+        length = len(self.deck.overview)
+
+        view_blocks = self.min_blocks
+        while view_blocks < length:
+            view_blocks *= 2
+
+        if view_blocks != self.view_blocks:
+            self.view_blocks = view_blocks
+            self._draw_columns(range(self.width))
+        else:
+            columns = {pos * self.width // view_blocks for pos in changed}
+            if length < self.length:
+                # Clear what was cut off the end.
+                first = length * self.width // view_blocks
+                last = self.length * self.width // view_blocks
+                columns.update(range(first, last + 1))
+            self._draw_columns(sorted(x for x in columns if x < self.width))
+
+        self.length = length
+        self._draw_regions()
+        self._draw_playhead()
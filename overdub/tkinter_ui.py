@@ -6,6 +6,7 @@ import os
 import tkinter as tk
 import tkinter.font
 from .status_line import format_status
+from .timeline import Timeline
 
 
 def get_font(size):
@@ -13,8 +14,11 @@ def get_font(size):
 
 
 class GUI:
-    def __init__(self, deck, filename, minimalist=False, fullscreen=False):
+    def __init__(
+        self, deck, filename, minimalist=False, fullscreen=False, stats=False
+    ):
         self.deck = deck
+        self.stats = stats
         self.filename = filename
         self.minimalist = minimalist
         self.fullscreen = fullscreen
@@ -37,24 +41,54 @@ class GUI:
         label.pack(side=tk.TOP, padx=10, pady=10)
         self.filename_label = label
 
+        if minimalist:
+            self.timeline = None
+        else:
+            self.timeline = Timeline(self.window, deck)
+            self.timeline.pack(side=tk.TOP, fill=tk.X, padx=10, pady=10)
+
         self.window.bind('<KeyPress-Return>', lambda *_: deck.toggle_record())
         self.window.bind('<KeyPress-space>', lambda *_: deck.toggle_play())
         self.window.bind('<KeyPress-Left>', lambda *_: deck.skip(-1))
         self.window.bind('<KeyPress-Right>', lambda *_: deck.skip(1))
+        self.window.bind('<KeyPress-u>', lambda *_: deck.undo())
+        self.window.bind('<KeyPress-r>', lambda *_: deck.redo())
+        self.window.bind(
+            '<KeyPress-bracketleft>', lambda *_: deck.mark_loop_start()
+        )
+        self.window.bind(
+            '<KeyPress-bracketright>', lambda *_: deck.mark_loop_end()
+        )
+        self.window.bind('<KeyPress-l>', lambda *_: deck.clear_loop())
         self.window.bind('<KeyPress-f>', lambda *_: self.toggle_fullscreen())
         self.window.bind('<KeyPress-Escape>', lambda *_: self.quit())
 
         self.window.attributes("-fullscreen", self.fullscreen)
 
+        # Redraw when the deck reports a change. The timeline needs
+        # finer steps than the status bar to move the play head smoothly.
+        self.subscription = deck.notifier.subscribe(ticks_per_second=10)
+        self.window.tk.createfilehandler(
+            self.subscription, tk.READABLE, lambda *_: self.update()
+        )
         self.update()
+        if stats:
+            self.update_stats()
 
     def toggle_fullscreen(self):
         self.fullscreen = not self.fullscreen
         self.window.attributes("-fullscreen", self.fullscreen)
 
     def update(self):
+        self.subscription.clear()
         self.update_display(self.deck.get_status())
-        self.window.after(50, self.update)
+        if self.timeline:
+            self.timeline.update()
+
+    def update_stats(self):
+        # Callback stats change all the time.
+        self.update()
+        self.window.after(500, self.update_stats)
 
     def update_display(self, status):
         if self.minimalist:
@@ -65,7 +99,7 @@ class GUI:
 
             self.statusbar.set(' '.join(flags))
         else:
-            self.statusbar.set(format_status(status))
+            self.statusbar.set(format_status(status, self.stats))
 
         background = {
             'recording': '#a00',  # Red
@@ -85,24 +119,39 @@ class GUI:
             pass
 
     def quit(self):
+        self.window.tk.deletefilehandler(self.subscription)
+        self.deck.notifier.unsubscribe(self.subscription)
         self.window.quit()
         self.window.destroy()
 
 
-def ui(deck, filename, minimalist=False):
-    if os.path.exists(filename):
+def ui(deck, filename, minimalist=False, stats=False, inputs=None):
+    """Run the Tk UI.
+
+    If an inputs.InputLoop with devices or timers is passed it is run
+    in a background thread.
+    """
+    if os.path.exists(filename) or deck.mapped:
         deck.load(filename)
+    deck.start_autosave(filename)
 
-    gui = GUI(deck, filename, minimalist=minimalist)
+    gui = GUI(deck, filename, minimalist=minimalist, stats=stats)
     # We start the stream here because
     # the call to Tk() causes an ALSA underrun.
     deck.start_stream()
+    run_inputs = inputs is not None and inputs.has_work()
+    if run_inputs:
+        inputs.start()
     try:
         gui.mainloop()
     finally:
+        if run_inputs:
+            inputs.stop()
         deck.stop_stream()
-        if len(deck.blocks) > 0:
+        gui.subscription.close()
+        if len(deck.tape) > 0:
             print(f'\nSaving to {filename}\n')
             deck.save(filename)
         else:
             print('\nNothing to save\n')
+        deck.close()
@@ -0,0 +1,252 @@
+"""Varispeed playback for scrubbing.
+
+The tape is played from a fractional frame position at any rate,
+forward or backward, with linear interpolation. At fast rates the
+samples are read from copies of the tape decimated by 8 or 64, so a
+block never needs more than a few blocks of input whatever the rate.
+
+The decimated copies are kept up to date by a background thread. The
+audio callback reports changed blocks the same way as for the overview.
+Only the part of the tape around the play position is decimated, so
+opening a long session or mapped file doesn't read it all.
+
+Like mixing, this uses NumPy or audioop if available.
+"""
+import math
+import array
+import threading
+from . import mixing
+from .dirty import DirtyRanges
+from .tape import Tape
+from .threads import start_thread
+
+numpy = mixing.numpy
+audioop = mixing.audioop
+
+# Each level is decimated by this much more than the one below.
+factor = 8
+max_rate = 100
+
+
+def _numpy_resample(data, channels, start, step, frames):
+    src = numpy.frombuffer(data, numpy.int16).reshape(-1, channels)
+    t = start + step * numpy.arange(frames)
+    i = numpy.clip(t.astype(numpy.int64), 0, len(src) - 2)
+    frac = (t - i).astype(numpy.float32)[:, None]
+    out = src[i] * (1 - frac) + src[i + 1] * frac
+    return out.astype(numpy.int16).tobytes()
+
+
+def _numpy_decimate(data, channels):
+    frames = numpy.frombuffer(data, numpy.int16).reshape(-1, factor, channels)
+    return frames.mean(axis=1).astype(numpy.int16).tobytes()
+
+
+def _reverse_frames(data, channels):
+    samples = array.array('h', bytes(data))
+    reversed_samples = array.array('h', samples)
+    for channel in range(channels):
+        reversed_samples[channel::channels] = samples[channel::channels][::-1]
+    return reversed_samples.tobytes()
+
+
+def _fit(data, size):
+    """Cut or pad data with silence to size bytes."""
+    if len(data) < size:
+        return data + bytes(size - len(data))
+    return data[:size]
+
+
+def _audioop_resample(data, channels, start, step, frames):
+    frame_size = channels * mixing.sample_size
+    if step < 0:
+        start = len(data) // frame_size - 1 - start
+        data = _reverse_frames(data, channels)
+        step = -step
+
+    # ratecv() can't start between frames, so the fraction is dropped.
+    data = bytes(data[int(start) * frame_size :])
+    inrate = max(round(step * 1000), 1)
+    out, _ = audioop.ratecv(
+        data, mixing.sample_size, channels, inrate, 1000, None
+    )
+    return _fit(out, frames * frame_size)
+
+
+def _audioop_decimate(data, channels):
+    out, _ = audioop.ratecv(
+        bytes(data), mixing.sample_size, channels, factor, 1, None
+    )
+    return _fit(out, len(data) // factor)
+
+
+def _python_resample(data, channels, start, step, frames):
+    src = memoryview(data).cast('h')
+    last = len(src) // channels - 2
+    out = array.array('h', bytes(frames * channels * mixing.sample_size))
+
+    for k in range(frames):
+        t = start + k * step
+        i = min(max(int(t), 0), last)
+        frac = t - i
+        for c in range(channels):
+            a = src[i * channels + c]
+            b = src[(i + 1) * channels + c]
+            out[k * channels + c] = int(a + (b - a) * frac)
+
+    return out.tobytes()
+
+
+def _python_decimate(data, channels):
+    samples = array.array('h', bytes(data))
+    out = array.array('h', bytes(len(data) // factor))
+    for channel in range(channels):
+        out[channel::channels] = samples[channel :: factor * channels]
+    return out.tobytes()
+
+
+resamplers = {'python': (_python_resample, _python_decimate)}
+if audioop is not None:
+    resamplers['audioop'] = (_audioop_resample, _audioop_decimate)
+if numpy is not None:
+    resamplers['numpy'] = (_numpy_resample, _numpy_decimate)
+
+
+def resample(data, channels, start, step, frames):
+    """Return frames frames read from data with linear interpolation.
+
+    Output frame k is taken from frame start + k * step of data, where
+    start is a fractional frame offset and step may be negative. data
+    must hold every frame that is read plus one.
+    """
+    func, _ = resamplers[mixing.backend]
+    return func(data, channels, start, step, frames)
+
+
+def decimate(data, channels):
+    """Return data with one frame for every factor frames."""
+    _, func = resamplers[mixing.backend]
+    return func(data, channels)
+
+
+class Varispeed:
+    def __init__(self, fmt, levels=2, window_seconds=120):
+        self.format = fmt
+        # Tapes decimated by factor, factor ** 2 and so on. Block j of
+        # a level is made from blocks j * factor and up of the level
+        # below.
+        self.levels = [Tape(fmt.bytes_per_block) for _ in range(levels)]
+        # One byte per block of each level, set when the block is up
+        # to date.
+        self._valid = [bytearray() for _ in range(levels)]
+        # Blocks this far either side of the play position are kept
+        # up to date. At max_rate the update interval is well inside.
+        self.window = fmt.sec2block(window_seconds)
+
+        self._dirty = DirtyRanges()
+        self._thread = None
+        self._stop = None
+
+    def mark_dirty(self, start, end=None):
+        """Report changed blocks. Called from the audio callback."""
+        self._dirty.add(start, end)
+
+    def update(self, read, length, position=0):
+        """Bring the decimated copies up to date around position.
+
+        read(pos) returns a block of the tape, length is the length of
+        the tape and position is the block being played.
+        """
+        ranges = self._dirty.pop_ranges(length)
+
+        # Aligned to the top level so every block in the window of a
+        # level is made from blocks in the window of the level below.
+        scale = factor ** len(self.levels)
+        first = max(0, position - self.window) // scale * scale
+        last = -(-min(length, position + self.window) // scale) * scale
+
+        for tape, valid in zip(self.levels, self._valid):
+            length = -(-length // factor)
+            first //= factor
+            last = min(last // factor, length)
+            ranges = [
+                (start // factor, -(-end // factor)) for start, end in ranges
+            ]
+
+            old_length = len(valid)
+            if old_length > length:
+                tape.truncate(length)
+                del valid[length:]
+            else:
+                valid.extend(bytes(length - old_length))
+            if 0 < old_length != length:
+                # The old last block may be partly cut off or padded.
+                valid[min(old_length, length) - 1] = 0
+            for start, end in ranges:
+                valid[start:end] = bytes(end - start)
+
+            pos = valid.find(0, first, last)
+            while pos >= 0:
+                start = pos * factor
+                data = b''.join(
+                    bytes(read(i)) for i in range(start, start + factor)
+                )
+                tape.write(pos, decimate(data, self.format.channels))
+                valid[pos] = 1
+                pos = valid.find(0, pos + 1, last)
+
+            read = tape.read
+
+    def start(self, read, get_length, get_position, interval=0.5):
+        """Run update() every interval seconds in a background thread."""
+        stop = self._stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.update(read, get_length(), get_position())
+
+        self._thread = start_thread(run)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def read(self, read, frame, rate):
+        """Return one block played from frame at rate.
+
+        read(pos) returns a block of the tape. frame may be fractional
+        and rate negative.
+        """
+        frames_per_block = self.format.frames_per_block
+        frame_size = self.format.frame_size
+
+        scale = 1
+        for tape in self.levels:
+            if abs(rate) / scale <= factor:
+                break
+            read = tape.read
+            scale *= factor
+
+        step = rate / scale
+        position = frame / scale
+        end = position + step * (frames_per_block - 1)
+        first = math.floor(min(position, end))
+        last = math.floor(max(position, end)) + 1
+
+        first_pos = first // frames_per_block
+        last_pos = last // frames_per_block
+        data = b''.join(
+            bytes(read(pos)) for pos in range(first_pos, last_pos + 1)
+        )
+        skip = first - first_pos * frames_per_block
+        data = memoryview(data)[skip * frame_size :]
+
+        return resample(
+            data,
+            self.format.channels,
+            position - first,
+            step,
+            frames_per_block,
+        )
@@ -0,0 +1,85 @@
+"""Low level access to the header of PCM WAV files.
+
+The wave module can only read or write whole files. These functions
+are used to update audio data in place.
+"""
+import wave
+import struct
+
+chunk_header = struct.Struct('<4sI')
+fmt_chunk = struct.Struct('<HHIIHH')
+
+header = struct.Struct('<4sI4s4sIHHIIHH4sI')
+header_size = header.size
+
+WAVE_FORMAT_PCM = 1
+
+
+def make_header(nchannels, sampwidth, framerate, data_size):
+    """Return a canonical 44 byte WAV header."""
+    frame_size = nchannels * sampwidth
+
+    return header.pack(
+        b'RIFF',
+        header_size - 8 + data_size,
+        b'WAVE',
+        b'fmt ',
+        fmt_chunk.size,
+        WAVE_FORMAT_PCM,
+        nchannels,
+        framerate,
+        framerate * frame_size,
+        frame_size,
+        sampwidth * 8,
+        b'data',
+        data_size,
+    )
+
+
+def read_header(infile):
+    """Return (nchannels, sampwidth, framerate, data_offset, data_size).
+
+    Raises wave.Error if the file is not a PCM WAV file.
+    """
+    infile.seek(0)
+    riff = infile.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+        raise wave.Error('file does not start with RIFF id')
+
+    fmt = None
+
+    while True:
+        data = infile.read(chunk_header.size)
+        if len(data) < chunk_header.size:
+            raise wave.Error('data chunk missing')
+
+        name, size = chunk_header.unpack(data)
+        if name == b'fmt ':
+            fmt = fmt_chunk.unpack(infile.read(fmt_chunk.size))
+            infile.seek(size - fmt_chunk.size + (size & 1), 1)
+        elif name == b'data':
+            if fmt is None:
+                raise wave.Error('data chunk before fmt chunk')
+            break
+        else:
+            infile.seek(size + (size & 1), 1)
+
+    format_tag, nchannels, framerate, _, _, bits = fmt
+    if format_tag != WAVE_FORMAT_PCM:
+        raise wave.Error(f'unknown format: {format_tag}')
+
+    return nchannels, bits // 8, framerate, infile.tell(), size
+
+
+def update_sizes(buf, data_offset, data_size):
+    """Write new RIFF and data chunk sizes into a mutable buffer."""
+    struct.pack_into('<I', buf, 4, data_offset - 8 + data_size)
+    struct.pack_into('<I', buf, data_offset - 4, data_size)
+
+
+def write_sizes(outfile, data_offset, data_size):
+    """Write new RIFF and data chunk sizes into an open file."""
+    outfile.seek(4)
+    outfile.write(struct.pack('<I', data_offset - 8 + data_size))
+    outfile.seek(data_offset - 4)
+    outfile.write(struct.pack('<I', data_size))